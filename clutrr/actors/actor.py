@@ -4,14 +4,31 @@ class Actor:
     """
     male or female actor
 
+    The irrelevant attributes are only drawn when they are first used, see ``attributes``
     """
+    __slots__ = ('gender', 'name', 'node_id', 'store', '_attributes')
+
     def __init__(self, gender='male', name='', node_id=0, store={}):
         self.gender = gender
         self.name = name
         self.node_id = node_id
+        self.store = store
+        self._attributes = None
+
+    @property
+    def attributes(self):
+        """
+        Irrelevant attributes, drawn on first access
+        :return: dict attribute : text
+        """
+        if self._attributes is None:
+            self.fill_attributes()
+        return self._attributes
+
+    def fill_attributes(self):
         ## irrelevant attributes
         ## also make the irrelevant attributes random. Not every entity will have them all
-        self.attributes = {
+        self._attributes = {
             'school'    : '',
             'location_born' : '',
             'social_media_active' : False,
@@ -20,17 +37,13 @@ class Actor:
             'hobby' : '',
             'sport': '',
         }
-        self.attribute_store = store.attribute_store
-        self.fill_attributes()
-
-    def fill_attributes(self):
-        for key,val in self.attribute_store.items():
+        for key,val in self.store.attribute_store.items():
             random_val = random.choice(val['options'])
             random_attr = '[{}]'.format(random_val)
             name = '[{}]'.format(self.name)
             random_placeholder = random.choice(val['placeholders'])
             text = random_placeholder.replace('e_x', name).replace('attr_x', random_attr) + ". "
-            self.attributes[key] = text
+            self._attributes[key] = text
 
     def __repr__(self):
         return "<Actor name:{} gender:{} node_id:{}".format(
@@ -47,6 +60,8 @@ class Entity:
     etype="work"
 
     """
+    __slots__ = ('name', 'etype', 'node_id')
+
     def __init__(self, name='', etype='', node_id=0):
         self.name = name
         self.etype = etype
@@ -1,8 +1,10 @@
 import numpy as np
-import names
 import copy
 import random
 from clutrr.actors.actor import Actor, Entity
+from clutrr.actors.edge_table import EdgeTable, FamilyView
+from clutrr.actors.name_pool import name_pool
+from clutrr.actors.simulator import simulate_skeletons
 from clutrr.store.store import Store
 
 #store = Store()
@@ -25,8 +27,9 @@ class Ancestry:
     - relation keyword to be taken from rules_store
     """
     def __init__(self, args, store:Store,
-                 relationship_type={'SO':1,'child':2}, taken_names=None):
-        self.family = {} # dict (node_id_a, node_id_b) : rel dict
+                 relationship_type={'SO':1,'child':2}, taken_names=None, skeleton=None):
+        self.edge_table = EdgeTable() # edges and their relations, see ``set_relation``
+        self.family = FamilyView(self.edge_table) # read only mapping (node_id_a, node_id_b) : rel dict
         self.family_data = {} # dict to hold node_id details
         self.work_data = {} # dict to hold work location id details
         self.store = store
@@ -41,57 +44,68 @@ class Ancestry:
         self.flipped = [] # track of nodes which are gender flipped
         self.taken_names = taken_names if taken_names else copy.deepcopy(self.store.attr_names) # keep track of names which are already taken
         self.names = {'male': [], 'female': []}
+        self.free_names = {'male': [], 'female': []} # names which may not be taken yet
         self._initialize_names()
-        self.simulate()
+        if skeleton is None:
+            self.simulate()
+        else:
+            self.load_skeleton(*skeleton)
         #self.add_work_relations()
 
     def _initialize_names(self):
-        taken_names = set(self.taken_names)
         for gender in ['male', 'female']:
-            generated_names = set()
-            while len(generated_names) < self.max_names:
-                name = names.get_first_name(gender=gender)
-                if name not in taken_names:
-                    generated_names.add(name)
-            self.names[gender] = list(generated_names)
+            self.names[gender] = name_pool.sample(gender, self.max_names, exclude=self.taken_names)
+            self.free_names[gender] = list(self.names[gender])
 
     def simulate(self):
         """
-        Main function to run the simulation to create a family tree
+        Main function to run the simulation to create a family tree, see ``simulate_skeletons``
 
         :return:
         """
         self.node_ct = 0
         self.levels = random.randint(1,self.max_levels)
-        # we are root, for now just add one head of family
-        gender = 'male'
-        nodes = self.add_members(gender=gender, num=1)
-        parents = nodes
-
-        for level in range(self.max_levels):
-            # build generation
-            generation_nodes = []
-            for node in parents:
-                # marry with probability p_marry
-                decision_marry = np.random.choice([True,False],1,p=[self.p_marry, 1-self.p_marry])
-                if decision_marry:
-                    # add the partner
-                    nodes =  self.add_members(gender=self.toggle_gender(node), num=1)
-                    self.make_relation(node, nodes[0], relation='SO')
-                    # always leave the last level as single children
-                    if level != self.max_levels - 1:
-                        # add the children for this parent
-                        num_childs = random.randint(self.min_child, self.max_child)
-                        child_nodes = self.add_members(num=num_childs)
-                        if len(child_nodes) > 0:
-                            for ch_node in child_nodes:
-                                self.make_relation(node, ch_node, relation='child')
-                                self.make_relation(nodes[0], ch_node, relation='child')
-                        generation_nodes.extend(child_nodes)
-            parents = generation_nodes
+        rng = np.random.default_rng(np.random.randint(2 ** 32, dtype=np.uint64))
+        skeletons = simulate_skeletons(rng, 1, self.max_levels, self.min_child, self.max_child, self.p_marry)
+        self.load_skeleton(*skeletons.skeleton(0))
+
+    def load_skeleton(self, genders, edges):
+        """
+        Build the family from a skeleton simulated before, instead of simulating it.
+        The nodes get new names. See ``clutrr.bank.TreeBank``
+        :param genders: list of the genders of the nodes, by node id
+        :param edges: list of (edge, relation) of the skeleton, in the order of simulation
+        :return:
+        """
+        self.node_ct = 0
+        for gender in genders:
+            self.add_members(gender=gender, num=1)
+        for edge, relation in edges:
+            self.set_relation(edge, relation)
 
     def get_first_name(self, gender):
-        return np.random.choice(self.names[gender], 1)[0]
+        """
+        Take a name of the gender which is not taken yet, uniformly among the names of the
+        ancestry. When they are all taken, ``max_names`` new names are drawn from the pool.
+        :param gender:
+        :return: name, added to the taken names
+        """
+        free = self.free_names[gender]
+        while True:
+            if len(free) == 0:
+                new_names = name_pool.sample(gender, max(self.max_names, 1), exclude=self.taken_names)
+                if len(new_names) == 0:
+                    raise ValueError("All the {} names are taken, the family tree is too large".format(gender))
+                self.names[gender].extend(new_names)
+                free.extend(new_names)
+            i = np.random.randint(len(free))
+            name = free[i]
+            free[i] = free[-1]
+            free.pop()
+            # names of both genders may have been taken by the other gender
+            if name not in self.taken_names:
+                self.taken_names.add(name)
+                return name
 
     def add_members(self, gender='male', num=1):
         """
@@ -107,9 +121,6 @@ class Ancestry:
                 gender = random.choice(['male', 'female'])
             # select a name that is not taken
             name = self.get_first_name(gender=gender)
-            while name in self.taken_names:
-                name = self.get_first_name(gender=gender)
-            self.taken_names.add(name)
             node = Actor(
                 name=name, gender=gender, node_id=node_id, store=self.store)
             added_nodes.append(node)
@@ -130,7 +141,131 @@ class Ancestry:
         node_b_id = node_b.node_id
         rel_tuple = (node_a_id, node_b_id)
         if rel_tuple not in self.family:
-            self.family[rel_tuple] = {'family': relation}
+            self.set_relation(rel_tuple, relation)
+
+    def set_relation(self, edge, relation, rel_type='family'):
+        """
+        Add or update the relation of an edge.
+        All writes to ``family`` should go through here (or ``append_relation``)
+        :param edge: (node_id_a, node_id_b)
+        :param relation:
+        :param rel_type:
+        :return: True if the edge was added or its relation changed
+        """
+        table = self.edge_table
+        row = table.row(edge)
+        if row is None:
+            row = table.add(edge)
+        elif table.has(row, rel_type) and table.get(row, rel_type) == relation:
+            return False
+        table.set(row, relation, rel_type)
+        return True
+
+    def append_relation(self, edge, relation, rel_type='work'):
+        """
+        Append a relation to an edge holding a list of relations (eg. work)
+        :param edge: (node_id_a, node_id_b)
+        :param relation:
+        :param rel_type:
+        :return:
+        """
+        row = self.edge_table.row(edge)
+        if row is None:
+            row = self.edge_table.add(edge)
+            self.edge_table.set(row, '', 'family')
+        self.edge_table.append(row, relation, rel_type)
+
+    def relation(self, edge, rel_type='family'):
+        """
+        Relation of an edge, same as ``family[edge][rel_type]`` but faster
+        :param edge: (node_id_a, node_id_b)
+        :param rel_type:
+        :return: relation
+        """
+        return self.edge_table.relation(edge, rel_type)
+
+    def relations(self, rel_type='family'):
+        """
+        All the edges with their relation, read in one pass over the edge table
+        :param rel_type:
+        :return: list of (edge, relation), in the order of insertion
+        """
+        return self.edge_table.items(rel_type)
+
+    def out_nodes(self, node):
+        """
+        Nodes y such that (node, y) is an edge
+        :param node:
+        :return: node ids, in the order of insertion
+        """
+        return self.edge_table.out_nodes(node)
+
+    def in_nodes(self, node):
+        """
+        Nodes x such that (x, node) is an edge
+        :param node:
+        :return: node ids, in the order of insertion
+        """
+        return self.edge_table.in_nodes(node)
+
+    def neighbours(self, node, relation, rel_type='family', incoming=False):
+        """
+        Nodes y such that (node, y) has the relation, or x such that (x, node) has it if incoming
+        :param node:
+        :param relation:
+        :param rel_type:
+        :param incoming:
+        :return: sorted node ids
+        """
+        return self.edge_table.neighbours(node, relation, rel_type, incoming)
+
+    def load_relations(self, src, dst, codes, relations, rel_type='family'):
+        """
+        Write the relations of a closed graph of the skeleton at once, and freeze it.
+        See ``EdgeTable.load``
+        :param src: node ids a of the edges (a, b), in the order of insertion
+        :param dst: node ids b
+        :param codes: relation codes of the edges in ``relations``
+        :param relations: list code : relation
+        :param rel_type:
+        :return:
+        """
+        self.edge_table.load(src, dst, codes, relations, rel_type)
+
+    def freeze(self, rel_type='family'):
+        """
+        Index the closed graph with sorted arrays instead of dicts, see ``EdgeTable.freeze``.
+        The graph can still be written afterwards, at the cost of rebuilding the dicts.
+        :param rel_type: relations used by ``neighbours``
+        :return:
+        """
+        self.edge_table.freeze(rel_type)
+
+    def to_matrix(self, codes, rel_type='family'):
+        """
+        Encode the graph as a N x N matrix of relation codes, 0 being no relation
+        :param codes: RelationCodes
+        :param rel_type:
+        :return: int8 numpy matrix
+        """
+        matrix = np.zeros((self.node_ct, self.node_ct), dtype=np.int8)
+        src, dst, rels, relations = self.edge_table.arrays(rel_type)
+        # table codes to RelationCodes codes, the last entry for the edges without relation
+        lookup = np.array([codes.encode(relation) for relation in relations] + [0], dtype=np.int8)
+        matrix[src, dst] = lookup[rels]
+        return matrix
+
+    def from_matrix(self, matrix, codes, rel_type='family'):
+        """
+        Update the graph with the relations of a matrix encoded with ``to_matrix``
+        :param matrix: int8 numpy matrix
+        :param codes: RelationCodes
+        :param rel_type:
+        :return:
+        """
+        src, dst = np.nonzero(matrix)
+        for edge, code in zip(zip(src.tolist(), dst.tolist()), matrix[src, dst].tolist()):
+            self.set_relation(edge, codes.decode(code), rel_type)
 
     def toggle_gender(self, node):
         if node.gender == 'male':
@@ -159,11 +294,10 @@ class Ancestry:
             self.flipped = []
         else:
             node = random.choice(candidates)
-            relations_with_node = [node_pair for node_pair in self.family.keys() if node_pair[0] == node]
-            SO_relation = [node_pair for node_pair in relations_with_node if self.family[node_pair]['family'] == 'SO']
+            SO_relation = list(self.neighbours(node, 'SO'))
             assert len(SO_relation) <= 1
             if len(SO_relation) == 1:
-                so_node = SO_relation[0][1]
+                so_node = SO_relation[0]
                 # flip both
                 self.family_data[node].gender = self.toggle_gender(self.family_data[node])
                 self.family_data[so_node].gender = self.toggle_gender(self.family_data[so_node])
@@ -178,12 +312,14 @@ class Ancestry:
                 #print("Flipped {} to {}".format(so_node, self.family_data[so_node].gender))
             else:
                 # only childs, flip them
+                old_name, old_gender = self.family_data[node].name, self.family_data[node].gender
                 self.family_data[node].gender = self.toggle_gender(self.family_data[node])
                 # choose a new gender appropriate name
                 gender = self.family_data[node].gender
-                while name in self.taken_names:
-                    name = self.get_first_name(gender=gender)
-                self.family_data[node].name = name
+                self.family_data[node].name = self.get_first_name(gender=gender)
+                # the old name can be given again
+                self.taken_names.discard(old_name)
+                self.free_names[old_gender].append(old_name)
                 self.flipped.append(node)
                 #print("flipping singles ...")
                 #print("Flipped {} to {}".format(node, self.family_data[node].gender))
@@ -219,21 +355,11 @@ class Ancestry:
             e_id = work_bins[wl]["id"]
             pops = work_bins[wl]["w"]
             for p in pops:
-                edge = (e_id, p)
-                if edge not in self.family:
-                    self.family[edge] = {'family':'', 'work': []}
-                if 'work' not in self.family[edge]:
-                    self.family[edge]['work'] = []
-                self.family[edge]['work'].append('works_at')
+                self.append_relation((e_id, p), 'works_at')
             # select manager
             manager = random.choice(pops)
             for p in pops:
-                edge = (p, manager)
-                if edge not in self.family:
-                    self.family[edge] = {'family':'', 'work': []}
-                if 'work' not in self.family[edge]:
-                    self.family[edge]['work'] = []
-                self.family[edge]['work'].append('manager')
+                self.append_relation((p, manager), 'manager')
 
 
 
@@ -0,0 +1,421 @@
+# Compact table of the edges of an ancestry, and the mapping view of Ancestry.family
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+import numpy as np
+
+# relation code of an edge which has no relation of a type
+ABSENT = -1
+# code of a pair of nodes which is not an edge, in the dense codes of a CsrIndex
+NO_EDGE = -2
+# max size of the dense codes of a CsrIndex, in cells per edge
+DENSE_CELLS_PER_EDGE = 16
+
+
+def _int_array(typecode, values):
+    """
+    Copy a numpy array into an array.array, which is faster to index and bisect from python
+    """
+    out = array(typecode)
+    out.frombytes(np.ascontiguousarray(values, dtype=np.dtype(typecode)).tobytes())
+    return out
+
+
+class CsrIndex:
+    """
+    Read only index of the edges of an EdgeTable, as arrays sorted by node with the offsets
+    of each node (CSR), built by ``EdgeTable.freeze`` once the graph is closed.
+
+    - out_ptr (N+1) : offsets of the edges (a, b) of each node a
+    - out_dst, out_row : b and row of the edges, sorted by a then b, to look an edge up
+    - out_code, out_node : relation code and b of the edges, sorted by a, relation code then b
+    - in_ptr (N+1) : offsets of the edges (a, b) of each node b
+    - in_code, in_node, in_row : relation code, a and row of the edges, sorted by b, relation code then a
+    - dense : relation codes of the pairs (a, b) at a * num_nodes + b, NO_EDGE if (a, b) is not an edge.
+     Only kept when there are at most DENSE_CELLS_PER_EDGE node pairs per edge, as the closed
+     family trees usually are, so that the relation of an edge is read without a bisect
+    """
+    def __init__(self, src, dst, codes):
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        codes = np.asarray(codes, dtype=np.int64)
+        self.num_nodes = int(max(src.max(), dst.max())) + 1 if len(src) else 0
+        self.out_ptr = _int_array('q', np.concatenate([[0], np.cumsum(np.bincount(src, minlength=self.num_nodes))]))
+        self.in_ptr = _int_array('q', np.concatenate([[0], np.cumsum(np.bincount(dst, minlength=self.num_nodes))]))
+        order = np.lexsort((dst, src))
+        self.out_dst = _int_array('i', dst[order])
+        self.out_row = _int_array('i', order)
+        order = np.lexsort((dst, codes, src))
+        self.out_code = _int_array('h', codes[order])
+        self.out_node = _int_array('i', dst[order])
+        order = np.lexsort((src, codes, dst))
+        self.in_code = _int_array('h', codes[order])
+        self.in_node = _int_array('i', src[order])
+        self.in_row = _int_array('i', order)
+        self.dense = None
+        if 0 < self.num_nodes ** 2 <= DENSE_CELLS_PER_EDGE * len(src):
+            dense = np.full(self.num_nodes ** 2, NO_EDGE, dtype=np.int16)
+            dense[src * self.num_nodes + dst] = codes
+            self.dense = _int_array('h', dense)
+
+    def row(self, edge):
+        x, y = edge
+        if not 0 <= x < self.num_nodes:
+            return None
+        out_dst = self.out_dst
+        hi = self.out_ptr[x + 1]
+        i = bisect_left(out_dst, y, self.out_ptr[x], hi)
+        if i < hi and out_dst[i] == y:
+            return self.out_row[i]
+        return None
+
+    def out_rows(self, node):
+        if not 0 <= node < self.num_nodes:
+            return []
+        return self.out_row[self.out_ptr[node]:self.out_ptr[node + 1]]
+
+    def in_rows(self, node):
+        if not 0 <= node < self.num_nodes:
+            return []
+        return self.in_row[self.in_ptr[node]:self.in_ptr[node + 1]]
+
+    def out_nodes(self, node, code):
+        if not 0 <= node < self.num_nodes:
+            return []
+        lo, hi = self.out_ptr[node], self.out_ptr[node + 1]
+        return self.out_node[bisect_left(self.out_code, code, lo, hi):bisect_right(self.out_code, code, lo, hi)]
+
+    def in_nodes(self, node, code):
+        if not 0 <= node < self.num_nodes:
+            return []
+        lo, hi = self.in_ptr[node], self.in_ptr[node + 1]
+        return self.in_node[bisect_left(self.in_code, code, lo, hi):bisect_right(self.in_code, code, lo, hi)]
+
+
+class EdgeTable:
+    """
+    Edges of an ancestry as parallel arrays, in the order of insertion
+
+    - src, dst : node ids of the edges
+    - rels : dict rel_type : relation codes of the edges, ABSENT if the edge has no relation of the type
+    - lists : dict rel_type : dict row : list of relations, for the relation types holding lists (eg. work)
+    - relations : list code : relation, and codes : dict relation : code
+
+    While the graph is written (eg. closed), edges are looked up with dicts:
+    - index : dict (node_id_a, node_id_b) : row
+    - out_adj, in_adj : dict node_id : array of the node ids b of its edges (node_id, b), and a of
+     its edges (a, node_id), in the order of insertion
+
+    Once the graph is closed, ``freeze`` replaces them with a CsrIndex of the arrays, whose dense
+    codes, when kept, answer ``relation`` and ``in`` without a bisect. A write to a frozen table
+    rebuilds the dicts first, see ``thaw``.
+    """
+    def __init__(self):
+        self.src = array('i')
+        self.dst = array('i')
+        self.rels = {}
+        self.lists = {}
+        self.relations = []
+        self.codes = {}
+        self.index = {}
+        self.out_adj = {}
+        self.in_adj = {}
+        self.csr = None
+        self.csr_type = None
+        self.dense = None # dense codes of the CsrIndex, and its number of nodes
+        self.dense_nodes = 0
+
+    def __len__(self):
+        return len(self.src)
+
+    def code(self, relation):
+        if relation not in self.codes:
+            self.codes[relation] = len(self.relations)
+            self.relations.append(relation)
+        return self.codes[relation]
+
+    def freeze(self, rel_type='family'):
+        """
+        Index the edges with a CsrIndex, by their relations of rel_type, and drop the dicts
+        :param rel_type:
+        :return:
+        """
+        if self.csr is not None and self.csr_type == rel_type:
+            return
+        codes = self.rels[rel_type] if rel_type in self.rels else array('h', [ABSENT]) * len(self.src)
+        self.csr = CsrIndex(self.src, self.dst, codes)
+        self.csr_type = rel_type
+        self.dense = self.csr.dense
+        self.dense_nodes = self.csr.num_nodes
+        self.index = None
+        self.out_adj = None
+        self.in_adj = None
+
+    def thaw(self):
+        """
+        Rebuild the dicts of a frozen table, to write to it
+        :return:
+        """
+        if self.csr is None:
+            return
+        self.index = {}
+        self.out_adj = {}
+        self.in_adj = {}
+        self.csr = None
+        self.csr_type = None
+        self.dense = None
+        self.dense_nodes = 0
+        for row, edge in enumerate(zip(self.src, self.dst)):
+            self._index_edge(edge, row)
+
+    def _index_edge(self, edge, row):
+        self.index[edge] = row
+        if edge[0] not in self.out_adj:
+            self.out_adj[edge[0]] = array('i')
+        self.out_adj[edge[0]].append(edge[1])
+        if edge[1] not in self.in_adj:
+            self.in_adj[edge[1]] = array('i')
+        self.in_adj[edge[1]].append(edge[0])
+
+    def add(self, edge):
+        """
+        Add an edge with no relation
+        :param edge: (node_id_a, node_id_b)
+        :return: row
+        """
+        self.thaw()
+        row = len(self.src)
+        self._index_edge(edge, row)
+        self.src.append(edge[0])
+        self.dst.append(edge[1])
+        for codes in self.rels.values():
+            codes.append(ABSENT)
+        return row
+
+    def row(self, edge):
+        """
+        :param edge: (node_id_a, node_id_b)
+        :return: row of the edge, None if it is not in the table
+        """
+        if self.csr is not None:
+            return self.csr.row(edge)
+        return self.index.get(edge)
+
+    def __contains__(self, edge):
+        if self.csr is None:
+            return edge in self.index
+        if self.dense is None:
+            return self.csr.row(edge) is not None
+        x, y = edge
+        n = self.dense_nodes
+        return 0 <= x < n and 0 <= y < n and self.dense[x * n + y] != NO_EDGE
+
+    def relation(self, edge, rel_type='family'):
+        """
+        Relation of an edge, without going through the mapping view
+        :param edge: (node_id_a, node_id_b)
+        :param rel_type:
+        :return: relation. KeyError if the edge has none of the type
+        """
+        dense = self.dense
+        if dense is not None and rel_type == self.csr_type:
+            x, y = edge
+            n = self.dense_nodes
+            if 0 <= x < n and 0 <= y < n:
+                code = dense[x * n + y]
+                if code >= 0:
+                    return self.relations[code]
+        row = self.index.get(edge) if self.csr is None else self.csr.row(edge)
+        if row is None:
+            raise KeyError(edge)
+        code = self.rels[rel_type][row]
+        if code == ABSENT:
+            raise KeyError(rel_type)
+        return self.relations[code]
+
+    def items(self, rel_type='family'):
+        """
+        :param rel_type:
+        :return: list of (edge, relation) of the edges having a relation of the type, in order of insertion
+        """
+        if rel_type not in self.rels:
+            return []
+        relations = self.relations
+        return [(edge, relations[code]) for edge, code in zip(zip(self.src, self.dst), self.rels[rel_type])
+                if code != ABSENT]
+
+    def out_nodes(self, node):
+        """
+        :return: node ids b of the edges (node, b), in the order of insertion
+        """
+        if self.csr is not None:
+            return [self.dst[row] for row in sorted(self.csr.out_rows(node))]
+        return self.out_adj.get(node, [])
+
+    def in_nodes(self, node):
+        """
+        :return: node ids a of the edges (a, node), in the order of insertion
+        """
+        if self.csr is not None:
+            return [self.src[row] for row in sorted(self.csr.in_rows(node))]
+        return self.in_adj.get(node, [])
+
+    def neighbours(self, node, relation, rel_type='family', incoming=False):
+        """
+        :param node:
+        :param relation:
+        :param rel_type:
+        :param incoming: if True, the nodes a of the edges (a, node), otherwise the nodes b of (node, b)
+        :return: sorted node ids of the edges with the relation
+        """
+        code = self.codes.get(relation)
+        if code is None or rel_type not in self.rels:
+            return []
+        if self.csr is not None and self.csr_type == rel_type:
+            return self.csr.in_nodes(node, code) if incoming else self.csr.out_nodes(node, code)
+        codes = self.rels[rel_type]
+        if incoming:
+            return sorted([other for other in self.in_nodes(node) if codes[self.row((other, node))] == code])
+        return sorted([other for other in self.out_nodes(node) if codes[self.row((node, other))] == code])
+
+    def has(self, row, rel_type):
+        if rel_type in self.lists:
+            return row in self.lists[rel_type]
+        return rel_type in self.rels and self.rels[rel_type][row] != ABSENT
+
+    def get(self, row, rel_type):
+        """
+        :return: relation of the edge, or list of relations. KeyError if the edge has none of the type
+        """
+        if rel_type in self.rels:
+            code = self.rels[rel_type][row]
+            if code != ABSENT:
+                return self.relations[code]
+        elif rel_type in self.lists and row in self.lists[rel_type]:
+            return self.lists[rel_type][row]
+        raise KeyError(rel_type)
+
+    def set(self, row, relation, rel_type='family'):
+        self.thaw()
+        if rel_type not in self.rels:
+            self.rels[rel_type] = array('h', [ABSENT]) * len(self.src)
+        self.rels[rel_type][row] = self.code(relation)
+
+    def append(self, row, relation, rel_type='work'):
+        self.lists.setdefault(rel_type, {}).setdefault(row, []).append(relation)
+
+    def rel_types(self, row):
+        return [rel_type for rel_type in list(self.rels) + list(self.lists) if self.has(row, rel_type)]
+
+    def arrays(self, rel_type='family'):
+        """
+        Edges as numpy arrays, for bulk scans. src and dst share the memory of the table.
+        :param rel_type:
+        :return: src, dst, relation codes, list code : relation
+        """
+        src = np.frombuffer(self.src, dtype=np.int32) if len(self.src) else np.zeros(0, dtype=np.int32)
+        dst = np.frombuffer(self.dst, dtype=np.int32) if len(self.dst) else np.zeros(0, dtype=np.int32)
+        if rel_type in self.rels:
+            codes = np.frombuffer(self.rels[rel_type], dtype=np.int16) if len(self.src) else np.zeros(0, dtype=np.int16)
+        else:
+            codes = np.full(len(self.src), ABSENT, dtype=np.int16)
+        return src, dst, codes, self.relations
+
+    def load(self, src, dst, codes, relations, rel_type='family'):
+        """
+        Write the relations of a whole graph at once, eg. a closed graph from a cache or a tree
+        bank, and freeze the table. The codes are mapped to the codes of the table once per
+        relation, not per edge.
+        :param src: node ids a of the edges (a, b), in the order of insertion. The edges already
+         in the table must be the first ones, in the same order
+        :param dst: node ids b
+        :param codes: relation codes of the edges in ``relations``, ABSENT for no relation
+        :param relations: list code : relation
+        :param rel_type:
+        :return:
+        """
+        num = len(self.src)
+        src = np.asarray(src, dtype=np.int32)
+        dst = np.asarray(dst, dtype=np.int32)
+        codes = np.asarray(codes, dtype=np.int64)
+        if len(src) < num or self.src.tobytes() != src[:num].tobytes() or self.dst.tobytes() != dst[:num].tobytes():
+            raise ValueError("The graph to load does not start with the edges of the table")
+        table_codes = np.array([self.code(relation) for relation in relations] + [ABSENT], dtype=np.int16)
+        # ABSENT (-1) picks the last code, ABSENT itself
+        rel_codes = table_codes[codes]
+        self.src.frombytes(src[num:].tobytes())
+        self.dst.frombytes(dst[num:].tobytes())
+        for other, other_codes in self.rels.items():
+            if other != rel_type:
+                other_codes.extend(array('h', [ABSENT]) * (len(src) - num))
+        self.rels[rel_type] = _int_array('h', rel_codes)
+        self.csr = None
+        self.freeze(rel_type)
+
+
+class EdgeRelations:
+    """
+    Relations of an edge of an EdgeTable, read as a dict rel_type : relation.
+    Compares equal to a dict, so it is not hashable.
+    """
+    __slots__ = ('table', 'row')
+    __hash__ = None
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, rel_type):
+        return self.table.get(self.row, rel_type)
+
+    def get(self, rel_type, default=None):
+        if self.table.has(self.row, rel_type):
+            return self.table.get(self.row, rel_type)
+        return default
+
+    def __contains__(self, rel_type):
+        return self.table.has(self.row, rel_type)
+
+    def keys(self):
+        return self.table.rel_types(self.row)
+
+    def items(self):
+        return [(rel_type, self.table.get(self.row, rel_type)) for rel_type in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __eq__(self, other):
+        return dict(self.items()) == (dict(other.items()) if hasattr(other, 'items') else other)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class FamilyView(Mapping):
+    """
+    Read only mapping (node_id_a, node_id_b) : relations of an EdgeTable, as the dict
+    ``Ancestry.family`` used to be. Writes go through ``Ancestry.set_relation``.
+    """
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, edge):
+        row = self.table.row(edge)
+        if row is None:
+            raise KeyError(edge)
+        return EdgeRelations(self.table, row)
+
+    def __contains__(self, edge):
+        return self.table.__contains__(edge)
+
+    def __iter__(self):
+        return zip(self.table.src, self.table.dst)
+
+    def __len__(self):
+        return len(self.table)
+
+    def items(self):
+        table = self.table
+        return ((edge, EdgeRelations(table, row)) for row, edge in enumerate(zip(table.src, table.dst)))
@@ -0,0 +1,52 @@
+# Pool of first names, loaded once per process from the data files of the names package
+
+import names
+import numpy as np
+
+
+class NamePool:
+    """
+    First names of the ``names`` package, by gender, with their frequencies.
+    The data files are read on first use, instead of on every ``names.get_first_name`` call.
+
+    - names : dict gender : list of names, capitalized as ``names.get_first_name``
+    - weights : dict gender : numpy array of the frequencies of the names, summing to 1
+    """
+    def __init__(self):
+        self.names = {}
+        self.weights = {}
+
+    def _load(self, gender):
+        gender_names = []
+        frequencies = []
+        with open(names.FILES['first:{}'.format(gender)]) as fp:
+            for line in fp:
+                name, frequency, _, _ = line.split()
+                gender_names.append(name.capitalize())
+                frequencies.append(float(frequency))
+        self.names[gender] = gender_names
+        self.weights[gender] = np.array(frequencies) / sum(frequencies)
+
+    def sample(self, gender, num, exclude=()):
+        """
+        Sample distinct names of a gender in one draw, weighted by their frequencies
+        as ``names.get_first_name``
+        :param gender: male/female
+        :param num: number of names. Fewer names are returned if there are not enough left
+        :param exclude: names not to sample, such as the names already taken
+        :return: list of names
+        """
+        if gender not in self.names:
+            self._load(gender)
+        exclude = set(exclude)
+        candidates = [i for i, name in enumerate(self.names[gender]) if name not in exclude]
+        num = min(num, len(candidates))
+        if num == 0:
+            return []
+        weights = self.weights[gender][candidates]
+        chosen = np.random.choice(len(candidates), num, replace=False, p=weights / weights.sum())
+        return [self.names[gender][candidates[i]] for i in chosen]
+
+
+# shared by every ancestry of the process
+name_pool = NamePool()
@@ -0,0 +1,162 @@
+# Batched simulation of family tree skeletons, one generation of all the trees at a time
+
+import numpy as np
+
+GENDERS = ['male', 'female']
+RELATIONS = ['SO', 'child']
+
+
+class Skeletons:
+    """
+    Skeletons of simulated family trees, as flat arrays. For T trees:
+
+    - node_ptr (T+1) : offsets of the nodes of each tree in ``genders``
+    - genders : gender of each node, index in GENDERS, by node id within its tree
+    - edge_ptr (T+1) : offsets of the edges of each tree in ``edges``
+    - edges (n,2) : edges (node_id_a, node_id_b), in the order of simulation
+    - rels : relation of each edge, index in RELATIONS
+    """
+    def __init__(self, node_ptr, genders, edge_ptr, edges, rels):
+        self.node_ptr = node_ptr
+        self.genders = genders
+        self.edge_ptr = edge_ptr
+        self.edges = edges
+        self.rels = rels
+
+    def __len__(self):
+        return len(self.node_ptr) - 1
+
+    def skeleton(self, index):
+        """
+        :param index: tree index
+        :return: list of genders by node id, list of (edge, relation), see ``Ancestry.load_skeleton``
+        """
+        genders = [GENDERS[g] for g in self.genders[self.node_ptr[index]:self.node_ptr[index + 1]].tolist()]
+        start, end = self.edge_ptr[index], self.edge_ptr[index + 1]
+        edges = self.edges[start:end].tolist()
+        rels = self.rels[start:end].tolist()
+        return genders, [((x, y), RELATIONS[rel]) for (x, y), rel in zip(edges, rels)]
+
+    def take(self, indices):
+        """
+        :param indices: tree indexes
+        :return: Skeletons of these trees, in the order of indices
+        """
+        empty = [np.zeros(0, dtype=np.int64)]
+        nodes = np.concatenate(empty + [np.arange(self.node_ptr[i], self.node_ptr[i + 1]) for i in indices])
+        edges = np.concatenate(empty + [np.arange(self.edge_ptr[i], self.edge_ptr[i + 1]) for i in indices])
+        return Skeletons(
+            node_ptr=np.concatenate([[0], np.cumsum(np.diff(self.node_ptr)[indices])]).astype(np.int64),
+            genders=self.genders[nodes],
+            edge_ptr=np.concatenate([[0], np.cumsum(np.diff(self.edge_ptr)[indices])]).astype(np.int64),
+            edges=self.edges[edges].reshape(-1, 2),
+            rels=self.rels[edges])
+
+    @staticmethod
+    def concatenate(parts):
+        """
+        :param parts: list of Skeletons
+        :return: Skeletons of all their trees, in order
+        """
+        return Skeletons(
+            node_ptr=np.concatenate([[0], np.cumsum(np.concatenate([np.diff(p.node_ptr) for p in parts]))]).astype(np.int64),
+            genders=np.concatenate([p.genders for p in parts]).astype(np.int8),
+            edge_ptr=np.concatenate([[0], np.cumsum(np.concatenate([np.diff(p.edge_ptr) for p in parts]))]).astype(np.int64),
+            edges=np.concatenate([p.edges.reshape(-1, 2) for p in parts]).astype(np.int64),
+            rels=np.concatenate([p.rels for p in parts]).astype(np.int8))
+
+    def to_arrays(self, prefix=''):
+        """
+        :param prefix: prefix of the array names, eg. to save them along with other arrays
+        :return: dict name : numpy array
+        """
+        return {prefix + name: getattr(self, name) for name in SKELETON_ARRAYS}
+
+    @staticmethod
+    def from_arrays(arrays, prefix=''):
+        """
+        :param arrays: dict name : numpy array, as written by ``to_arrays``
+        :param prefix:
+        :return: Skeletons
+        """
+        return Skeletons(**{name: arrays[prefix + name] for name in SKELETON_ARRAYS})
+
+
+# arrays of Skeletons, as saved by ``Skeletons.to_arrays``
+SKELETON_ARRAYS = ['node_ptr', 'genders', 'edge_ptr', 'edges', 'rels']
+
+
+def simulate_skeletons(rng, num_trees, max_levels, min_child, max_child, p_marry):
+    """
+    Simulate the skeletons of num_trees family trees, as ``Ancestry.simulate`` does for one tree:
+    starting from a male head of family, each node of a generation marries with probability
+    p_marry, and each couple has between min_child and max_child children, except in the last
+    generation. Node ids are given in the order of ``Ancestry.simulate``: the partner, then the
+    children of each couple.
+
+    Each generation of all the trees is drawn at once, from vectors of marriages, child counts
+    and genders.
+    :param rng: numpy.random.Generator
+    :param num_trees:
+    :param max_levels:
+    :param min_child:
+    :param max_child:
+    :param p_marry:
+    :return: Skeletons
+    """
+    node_ct = np.ones(num_trees, dtype=np.int64)
+    # nodes and edges of all the trees, with their tree, sorted at the end
+    node_tree, node_ids, node_genders = [np.arange(num_trees)], [np.zeros(num_trees, dtype=np.int64)], \
+        [np.zeros(num_trees, dtype=np.int8)]
+    edge_tree, edge_order, edge_src, edge_dst, edge_rels = [], [], [], [], []
+    parents_tree = np.arange(num_trees)
+    parents_id = np.zeros(num_trees, dtype=np.int64)
+    parents_gender = np.zeros(num_trees, dtype=np.int8)
+    order = 0 # order of the edges across generations and couples
+    for level in range(max_levels):
+        marry = rng.random(len(parents_tree)) < p_marry
+        trees, ids, partner_genders = parents_tree[marry], parents_id[marry], 1 - parents_gender[marry]
+        if level != max_levels - 1:
+            num_childs = rng.integers(min_child, max_child + 1, size=len(trees))
+        else:
+            # always leave the last level as single children
+            num_childs = np.zeros(len(trees), dtype=np.int64)
+        # each couple takes a block of ids, the partner then the children. Parents are sorted by tree,
+        # so the block of a couple starts after the blocks of the previous couples of its tree
+        blocks = 1 + num_childs
+        before = np.cumsum(blocks) - blocks
+        first = np.searchsorted(trees, trees, side='left')
+        partner_ids = node_ct[trees] + before - before[first]
+        node_ct += np.bincount(trees, weights=blocks, minlength=num_trees).astype(np.int64)
+        # children, in the order of their couple
+        total = int(num_childs.sum())
+        child_couple = np.repeat(np.arange(len(trees)), num_childs)
+        child_rank = np.arange(total) - np.repeat(np.cumsum(num_childs) - num_childs, num_childs)
+        child_ids = partner_ids[child_couple] + 1 + child_rank
+        child_genders = rng.integers(0, 2, size=total).astype(np.int8)
+        # as ``Ancestry.add_members``, an only child is male
+        child_genders[num_childs[child_couple] == 1] = 0
+        node_tree += [trees, trees[child_couple]]
+        node_ids += [partner_ids, child_ids]
+        node_genders += [partner_genders, child_genders]
+        # edges of each couple: the SO edge, then (parent, child) and (partner, child) for each child
+        couple_order = order + np.cumsum(1 + 2 * num_childs) - (1 + 2 * num_childs)
+        order += int((1 + 2 * num_childs).sum())
+        edge_tree += [trees, trees[child_couple], trees[child_couple]]
+        edge_order += [couple_order, couple_order[child_couple] + 1 + 2 * child_rank,
+                       couple_order[child_couple] + 2 + 2 * child_rank]
+        edge_src += [ids, ids[child_couple], partner_ids[child_couple]]
+        edge_dst += [partner_ids, child_ids, child_ids]
+        edge_rels += [np.zeros(len(trees), dtype=np.int8), np.ones(2 * total, dtype=np.int8)]
+        # the children are the parents of the next generation
+        parents_tree, parents_id, parents_gender = trees[child_couple], child_ids, child_genders
+    node_tree, node_ids = np.concatenate(node_tree), np.concatenate(node_ids)
+    nodes = np.lexsort((node_ids, node_tree))
+    edge_tree = np.concatenate(edge_tree)
+    edges = np.lexsort((np.concatenate(edge_order), edge_tree))
+    return Skeletons(
+        node_ptr=np.concatenate([[0], np.cumsum(node_ct)]),
+        genders=np.concatenate(node_genders)[nodes],
+        edge_ptr=np.concatenate([[0], np.cumsum(np.bincount(edge_tree, minlength=num_trees))]),
+        edges=np.stack([np.concatenate(edge_src)[edges], np.concatenate(edge_dst)[edges]], axis=1),
+        rels=np.concatenate(edge_rels)[edges])
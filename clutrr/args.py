@@ -1,21 +1,40 @@
 ## Note: With these current args (max level 3, min_child = max_child = 4), its only possible to generate
-## upto 8 relations in my cpu. The code is not optimized yet.
+## upto 8 relations in my cpu. For larger trees, use `--closure matrix` to close the family graph.
 
 import argparse
 
-def get_args():
-    parser = argparse.ArgumentParser()
+# closures which do not derive exactly the graph of the worklist closure, refused with --equal and --resume
+EXPERIMENTAL_CLOSURES = ['matrix', 'bounded']
+
+def get_parser(add_help=True):
+    parser = argparse.ArgumentParser(add_help=add_help)
     # graph parameters
     parser.add_argument("--max_levels", default=3, type=int, help="max number of levels")
     parser.add_argument("--min_child", default=4, type=int, help="max number of children per node")
     parser.add_argument("--max_child", default=4, type=int, help="max number of children per node")
     parser.add_argument("--max_names", default=10, type=int, help="max number of names to use")
     parser.add_argument("--p_marry", default=1.0, type=float, help="Probability of marriage among nodes")
+    parser.add_argument("--closure", default="worklist", choices=['worklist', 'matrix', 'bounded'],
+                        help="Closure of the family graph: worklist (exact), matrix (experimental, vectorized, for large "
+                             "trees) or bounded (experimental, only the edges within --relation_length hops, for large "
+                             "populations). The experimental closures do not always derive the graph of worklist, and "
+                             "cannot be used with --equal or --resume")
+    parser.add_argument("--closure_cache_dir", default="", type=str,
+                        help="Directory to cache the closed family graphs across runs. Disabled if empty")
+    parser.add_argument("--tree_bank", default="", type=str,
+                        help="Bank of closed family trees to draw from instead of simulating them, "
+                             "see python -m clutrr.bank build. Disabled if empty")
     # story parameters
     parser.add_argument("--abstracts", default=1, type=int, help="Abstract lines per relation")
     parser.add_argument("--boundary",default=True, action='store_true', help='Boundary in entities')
     parser.add_argument("--output", default="gen_m3", type=str, help='Prefix of the output file')
     parser.add_argument("--relation_length", default=3, type=int, help="Max relation path length")
+    parser.add_argument("--expansion_cache", default=100000, type=int, help="Max number of edges to keep the expansions of, 0 to keep none")
+    parser.add_argument("--build_budget", default=0, type=int,
+                        help="Derive at most this many puzzles per story left to generate from each gender flip "
+                             "of the tree, instead of deriving from all its edges. Disabled if 0")
+    parser.add_argument("--exhaustive", default=False, action='store_true',
+                        help="Sample each story from all the derivations of an edge, instead of a random derivation")
     # noise choices
     parser.add_argument("--noise_support", default=False, action='store_true',
                         help="Noise type: Supporting facts")
@@ -54,6 +73,25 @@ def get_args():
     parser.add_argument("--template_length", type=int, default=2, help="Max Length of the template to substitute")
     parser.add_argument("--template_file", type=str, default="amt_placeholders.json", help="location of placeholders")
     parser.add_argument("--output_dir", type=str, default="data", help="output_dir")
+    parser.add_argument("--output_format", type=str, default="csv", choices=['csv', 'jsonl', 'parquet'],
+                        help="Format of the dataset files. parquet requires pyarrow")
+    parser.add_argument("--chunk_size", type=int, default=10000, help="Number of rows kept in memory before writing them")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes generating the shards of each task")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Master seed. If set, or with several workers, the rows are generated in shards seeded from it, "
+                             "and the output does not depend on the number of workers")
+    parser.add_argument("--shard_rows", type=int, default=1000, help="Number of rows per shard")
+    parser.add_argument("--resume", type=str, default=None,
+                        help="Dataset folder of an interrupted sharded run to resume, with its own args. "
+                             "Only the runs with --seed or --workers > 1 can be resumed")
+
 
+    return parser
 
-    return parser.parse_args()
+
+def get_args():
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.closure in EXPERIMENTAL_CLOSURES and (args.equal or args.resume):
+        parser.error("--closure {} is experimental and cannot be used with --equal or --resume".format(args.closure))
+    return args
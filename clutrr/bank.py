@@ -0,0 +1,240 @@
+# Bank of family trees simulated and closed ahead of time
+#
+# Build a bank with the tree arguments of the datasets to generate, eg:
+#   python -m clutrr.bank build --tree_bank bank.npz --trees 1000 --max_levels 4 --closure matrix
+# and generate from it with --tree_bank bank.npz
+
+import os
+import json
+import random
+import hashlib
+import argparse
+import numpy as np
+from clutrr.args import get_parser
+from clutrr.store.store import Store
+from clutrr.actors.ancestry import Ancestry
+from clutrr.actors.edge_table import ABSENT
+from clutrr.actors.simulator import Skeletons, simulate_skeletons
+from clutrr.relations.builder import RelationBuilder
+from clutrr.relations.cache import ClosureEntry, closure_cache, closure_mode
+
+# version of the layout of the bank arrays
+BANK_VERSION = 2
+
+
+def rules_digest(rules):
+    """
+    Digest of the rules store, a bank can only be used with the rules it was closed with
+    :param rules:
+    :return: hex digest
+    """
+    return hashlib.sha1(json.dumps(rules, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class TreeBank:
+    """
+    Family trees simulated and closed ahead of time, saved as flat arrays in a npz file.
+    Trees sharing the same skeleton share its closed graph, only their genders differ.
+
+    Per tree, for T trees:
+        - tree_node_ptr, tree_genders, tree_edge_ptr, tree_edges, tree_rels : the skeletons
+         of the trees, in the layout of ``Skeletons``
+        - tree_closure (T) : closed graph of each tree
+    Per closed graph, for C graphs:
+        - closure_ptr (C+1), closure_edges (m,2), closure_rels : closed edges, in order of insertion
+    Per closed edge:
+        - expansion_ptr (m+1), expansion_nodes : middle nodes z of the expansions [(x,z),(z,y)],
+         in the order of ``RelationBuilder.get_expansions``
+
+    Closed relations are stored as codes of ``RelationCodes``, and loaded as such in the ancestries.
+    """
+    def __init__(self, arrays, store, rel_type='family'):
+        """
+        :param arrays: dict name : numpy array
+        :param store: Store, whose rules must be the rules of the bank
+        :param rel_type:
+        """
+        if 'version' not in arrays or int(arrays['version']) != BANK_VERSION:
+            raise ValueError("The tree bank was built by an older version, build it again")
+        if str(arrays['rules']) != rules_digest(store.rules_store):
+            raise ValueError("The tree bank was built with other rules, build it again")
+        self.arrays = arrays
+        self.rel_type = rel_type
+        self.closure = str(arrays['closure'])
+        self.codes = store.compiled.relation_codes[rel_type]
+        self.trees = Skeletons.from_arrays(arrays, 'tree_')
+
+    def __len__(self):
+        return len(self.trees)
+
+    def skeleton(self, index):
+        """
+        :param index: tree index
+        :return: list of genders by node id, list of (edge, relation) of the skeleton
+        """
+        return self.trees.skeleton(index)
+
+    def entry(self, index):
+        """
+        Closed graph of a tree, along with all its expansions
+        :param index: tree index
+        :return: ClosureEntry
+        """
+        closure = int(self.arrays['tree_closure'][index])
+        start, end = self.arrays['closure_ptr'][closure:closure + 2].tolist()
+        edges = self.arrays['closure_edges'][start:end]
+        rels = self.arrays['closure_rels'][start:end].astype(np.int16)
+        # code 0 of RelationCodes is no relation
+        rels[rels == 0] = ABSENT
+        ptr = self.arrays['expansion_ptr'][start:end + 1].tolist()
+        nodes = self.arrays['expansion_nodes'][ptr[0]:ptr[-1]].tolist()
+        expansions = {}
+        for i, (x, y) in enumerate(edges.tolist()):
+            if ptr[i + 1] > ptr[i]:
+                expansions[(x, y)] = [[(x, z), (z, y)] for z in nodes[ptr[i] - ptr[0]:ptr[i + 1] - ptr[0]]]
+        return ClosureEntry(edges[:, 0], edges[:, 1], rels, self.codes.relations, expansions)
+
+    def ancestry(self, args, store, index=None):
+        """
+        Draw a tree of the bank. Its closed graph is put in ``closure_cache``, so that the
+        ``RelationBuilder`` of the ancestry does not close it again.
+        :param args:
+        :param store:
+        :param index: tree index, drawn at random if None
+        :return: Ancestry
+        """
+        if index is None:
+            index = random.randrange(len(self))
+        anc = Ancestry(args, store, skeleton=self.skeleton(index))
+        if closure_mode(args) != self.closure:
+            print("The tree bank was closed with --closure {}, closing the tree with --closure {}".format(
+                self.closure, closure_mode(args)))
+        signature = closure_cache.signature(anc, store.rules_store, self.closure, self.rel_type)
+        if closure_cache.get(signature) is None:
+            closure_cache.put(signature, self.entry(index))
+        return anc
+
+
+# tree banks loaded in this process, by path and modification time
+tree_banks = {}
+
+
+def load_tree_bank(path, store):
+    """
+    Load a tree bank, once per process
+    :param path: npz file written by ``build_bank``
+    :param store:
+    :return: TreeBank
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in tree_banks:
+        with np.load(path, allow_pickle=False) as data:
+            tree_banks[key] = TreeBank({name: data[name] for name in data.files}, store)
+    return tree_banks[key]
+
+
+def build_bank(args, store, num_trees, rel_type='family', max_simulated=10):
+    """
+    Simulate and close num_trees family trees with the tree arguments. The trees which cannot
+    hold a story of ``args.relation_length`` edges (eg. a single node with --p_marry < 1) are
+    skipped, and more trees are simulated instead.
+    :param args:
+    :param store:
+    :param num_trees:
+    :param rel_type:
+    :param max_simulated: give up after simulating this many times num_trees trees
+    :return: dict name : numpy array, see ``TreeBank``
+    """
+    codes = store.compiled.relation_codes[rel_type]
+    trees = [] # Skeletons of the kept trees of each batch
+    tree_closure = []
+    closures = {} # signature : closed graph index
+    degenerate = set() # signatures of the skeletons without any story
+    closure_edges, closure_rels, closure_ptr = [], [], [0]
+    expansion_nodes, expansion_ptr = [], [0]
+    num_simulated = 0
+    rng = np.random.default_rng(np.random.randint(2 ** 32, dtype=np.uint64))
+    while len(tree_closure) < num_trees:
+        if num_simulated >= max_simulated * num_trees:
+            raise ValueError("Only {} of {} simulated trees can hold a story of {} relations, "
+                             "consider increasing the family tree".format(len(tree_closure), num_simulated,
+                                                                          args.relation_length))
+        # the skeletons of the trees left are simulated at once
+        simulated = simulate_skeletons(rng, num_trees - len(tree_closure), args.max_levels, args.min_child,
+                                       args.max_child, args.p_marry)
+        num_simulated += len(simulated)
+        kept = []
+        for tree in range(len(simulated)):
+            anc = Ancestry(args, store, skeleton=simulated.skeleton(tree))
+            signature = closure_cache.signature(anc, store.rules_store, closure_mode(args), rel_type)
+            if signature in degenerate:
+                continue
+            if signature not in closures:
+                rb = RelationBuilder(args, store, anc)
+                rb.precompute_expansions(list(anc.family.keys()), rel_type)
+                # the bank holds the closed graphs, do not keep them twice
+                closure_cache.clear()
+                if not any(rb.count_derivations(edge, args.relation_length) > 0 for edge in anc.family):
+                    degenerate.add(signature)
+                    print("Skipping a tree of {} nodes without any story of {} relations".format(
+                        anc.node_ct, args.relation_length))
+                    continue
+                closures[signature] = len(closures)
+                src, dst, rels, relations = anc.edge_table.arrays(rel_type)
+                # table codes to RelationCodes codes, ABSENT (-1) picks the last one, no relation
+                rel_codes = np.array([codes.encode(rel) for rel in relations] + [0], dtype=np.int8)
+                closure_edges.append(np.stack([src, dst], axis=1))
+                closure_rels.append(rel_codes[rels])
+                for x, y, code in zip(src.tolist(), dst.tolist(), rels.tolist()):
+                    if code != ABSENT:
+                        expansion_nodes.extend([expansion[0][1] for expansion in rb.get_expansions((x, y), rel_type)])
+                    expansion_ptr.append(len(expansion_nodes))
+                closure_ptr.append(closure_ptr[-1] + len(src))
+            kept.append(tree)
+            tree_closure.append(closures[signature])
+            print("Tree {}/{} : {} nodes, {} distinct skeletons".format(
+                len(tree_closure), num_trees, anc.node_ct, len(closures)))
+        trees.append(simulated.take(kept))
+    arrays = Skeletons.concatenate(trees).to_arrays('tree_')
+    arrays.update({
+        'version': np.array(BANK_VERSION),
+        'rules': np.array(rules_digest(store.rules_store)),
+        'closure': np.array(closure_mode(args)),
+        'tree_closure': np.array(tree_closure, dtype=np.int32),
+        'closure_ptr': np.array(closure_ptr, dtype=np.int64),
+        'closure_edges': np.concatenate(closure_edges).astype(np.int32).reshape(-1, 2),
+        'closure_rels': np.concatenate(closure_rels).astype(np.int8),
+        'expansion_ptr': np.array(expansion_ptr, dtype=np.int64),
+        'expansion_nodes': np.array(expansion_nodes, dtype=np.int32),
+    })
+    return arrays
+
+
+def save_bank(path, arrays):
+    # write and rename, so that a bank being built is never read
+    tmp_path = path + '.{}.tmp.npz'.format(os.getpid())
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(parents=[get_parser(add_help=False)],
+                                     description="Bank of closed family trees, to generate with --tree_bank")
+    parser.add_argument("command", choices=['build'], help="build : simulate and close the trees of the bank")
+    parser.add_argument("--trees", default=100, type=int, help="Number of trees of the bank")
+    args = parser.parse_args()
+    if not args.tree_bank:
+        parser.error("--tree_bank is required, the file to write the bank to")
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+    store = Store(args)
+    arrays = build_bank(args, store, args.trees)
+    save_bank(args.tree_bank, arrays)
+    print("Saved {} trees with {} distinct skeletons to {}".format(
+        args.trees, len(arrays['closure_ptr']) - 1, args.tree_bank))
+
+
+if __name__ == '__main__':
+    main()
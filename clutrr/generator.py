@@ -2,16 +2,17 @@
 
 from clutrr.actors.ancestry import Ancestry
 from clutrr.relations.builder import RelationBuilder
+from clutrr.relations.patterns import PatternIndex, PatternScheduler
+from clutrr.bank import load_tree_bank
 from tqdm import tqdm
 import random
 import numpy as np
-import json
-import copy
 
 from clutrr.args import get_args
 from clutrr.store.store import Store
-from clutrr.utils.utils import comb_indexes
-import pandas as pd
+from clutrr.store.templates import load_amt_templates
+from clutrr.utils.utils import sample_grouping
+from clutrr.utils.sinks import make_sink
 
 #store = Store()
 
@@ -20,87 +21,123 @@ class TemplateUser:
     Replaces story with the templates obtained from AMT
     """
     def __init__(self, templates, family):
-        self.templates = copy.copy(templates)
-        self.family = family # dict containing node informations
+        """
+        :param templates: AmtTemplates, see ``load_amt_templates``
+        :param family: dict containing node informations
+        """
+        self.templates = templates
+        self.family = family
         self.used_template = ''
-        self.entity_id_dict = {}
-        self.seen_ent = set()
 
-    def choose_template(self, f_comb, entities, verbose=False):
+    def gender_comb(self, entities):
+        """
+        Unique entities in order of first appearance, which are the entity ids of the
+        templates, and their genders
+        :param entities:
+        :return: list of entities, gender combination such as 'male-female'
+        """
+        unique = list(dict.fromkeys(entities))
+        return unique, '-'.join([self.family[ent].gender for ent in unique])
+
+    def has_template(self, f_comb, entities):
         """
-        Choose a template to use. Do not use the same template in this current context
-        :return:
+        Whether a template is available for the relations and the entities
+        :param f_comb: relations joined by '-'
+        :param entities:
+        :return: bool
+        """
+        return (f_comb, self.gender_comb(entities)[1]) in self.templates
+
+    def choose_template(self, f_comb, gender_comb, verbose=False):
+        """
+        Choose a template to use
+        :return: AmtTemplate
         """
-        self.entity_id_dict = {}
-        self.seen_ent = set()
-        gender_comb = []
-        # build the dictionary of entity - ids
-        for ent in entities:
-            if ent not in self.seen_ent:
-                gender_comb.append(self.family[ent].gender)
-                self.seen_ent.add(ent)
-                self.entity_id_dict[ent] = len(self.entity_id_dict)
-        gender_comb = '-'.join(gender_comb)
         if verbose:
             print(f_comb)
             print(gender_comb)
-            print(len(self.templates[f_comb][gender_comb]))
-        if len(self.templates[f_comb][gender_comb]) == 0:
+        if (f_comb, gender_comb) not in self.templates:
             raise NotImplementedError("template combination not found.")
-        available_templates = self.templates[f_comb][gender_comb]
-        chosen_template = random.choice(available_templates)
-        self.used_template = chosen_template
-        used_i = self.templates[f_comb][gender_comb].index(chosen_template)
-        # remove the used template
-        # del self.templates[f_comb][gender_comb][used_i]
+        chosen_template = random.choice(self.templates.get(f_comb, gender_comb))
+        self.used_template = chosen_template.text
         return chosen_template
 
-
     def replace_template(self, f_comb, entities, verbose=False):
-        chosen_template = self.choose_template(f_comb, entities, verbose=verbose)
+        unique, gender_comb = self.gender_comb(entities)
+        chosen_template = self.choose_template(f_comb, gender_comb, verbose=verbose)
+        return chosen_template.render(['[{}]'.format(self.family[ent].name) for ent in unique])
 
-        for ent_id, ent in enumerate(list(set(entities))):
-            node = self.family[ent]
-            gender = node.gender
-            name = node.name
-            chosen_template = chosen_template.replace('ENT_{}_{}'.format(self.entity_id_dict[ent], gender), '[{}]'.format(name))
-        return chosen_template
+
+COLUMNS = ['id', 'story', 'query', 'text_query', 'target', 'text_target', 'clean_story', 'proof_state', 'f_comb', 'task_name', 'story_edges','edge_types','query_edge','genders', 'syn_story']
 
 
-def generate_rows(args, store, task_name):
+def generate_rows(args, store, task_name, max_failed_trees=100):
+    """
+    Generate the rows of a task, lazily. The rows follow ``COLUMNS``, and are usually
+    written with a sink from ``clutrr.utils.sinks``
+    :param args:
+    :param store:
+    :param task_name:
+    :param max_failed_trees: number of trees in a row without any puzzle before giving up
+    :return: generator of rows
+    """
     # generate
     print(args.relation_length)
-    print("Loading templates...")
-    templates = json.load(open(args.template_file))
+    templates = None
+    if args.use_mturk_template:
+        print("Loading templates...")
+        templates = load_amt_templates(args.template_file)
     pb = tqdm(total=args.num_rows)
     num_stories = args.num_rows
     stories_left = num_stories
-    columns = ['id', 'story', 'query', 'text_query', 'target', 'text_target', 'clean_story', 'proof_state', 'f_comb', 'task_name', 'story_edges','edge_types','query_edge','genders', 'syn_story']
     f_comb_count = {}
-    rows = []
-    anc_num = 0
-    anc_num += 1
-    anc = Ancestry(args, store)
-    rb = RelationBuilder(args, store, anc)
+    scheduler = PatternScheduler()
+    bank = load_tree_bank(args.tree_bank, store) if args.tree_bank else None
+
+    def new_builder():
+        anc = bank.ancestry(args, store) if bank else Ancestry(args, store)
+        return RelationBuilder(args, store, anc)
+
+    anc_num = 1
+    rb = new_builder()
+    num_failed = 0 # builds without any puzzle in a row, on the current tree
+    failed_trees = 0
     while stories_left > 0:
-        status = rb.build()
+        status = rb.build(budget=stories_left * args.build_budget if args.build_budget else None)
+        if status and args.equal:
+            # select the puzzles to emit before generating their facts and text. A round
+            # where none is selected counts as a failed build
+            rb.keep_puzzles(scheduler.select(PatternIndex(rb.puzzles), limit=stories_left))
+            status = len(rb.puzzles) > 0
         if not status:
-            rb.reset_puzzle()
-            rb.anc.next_flip()
+            num_failed += 1
+            if num_failed < len(rb.anc.family_data):
+                rb.reset_puzzle()
+                rb.anc.next_flip()
+                continue
+            # no puzzle after a round of flips, the tree is too small for the relation length
+            failed_trees += 1
+            if failed_trees >= max_failed_trees:
+                raise ValueError("No puzzles could be generated from {} family trees in a row, "
+                                 "consider increasing the family tree".format(failed_trees))
+            rb = new_builder()
+            anc_num += 1
+            num_failed = 0
             continue
-        rb.add_facts()
+        num_failed = 0
+        failed_trees = 0
         # keeping a count of generated patterns to make sure we have homogenous distribution
-        if len(f_comb_count) > 0 and args.equal:
-            min_c = min([v for k,v in f_comb_count.items()])
-            weight = {k:(min_c/v) for k,v in f_comb_count.items()}
-            rb.generate_puzzles(weight)
+        if args.equal:
+            rb.add_facts()
+            rb.generate_puzzles(prune=False)
         else:
+            rb.add_facts()
             rb.generate_puzzles()
         # now we have got the puzzles, add them to the story
         for pid, puzzle in rb.puzzles.items():
-            story_edges = puzzle['text_story']       # dict of edge:text
-            clean_story = ''.join([puzzle['text_story'][e] for e in story_edges])
-            noise_edge_list = [v for k,v in puzzle.items() if 'text_fact' in k]
+            story_edges = puzzle.text_story       # dict of edge:text
+            clean_story = ''.join([puzzle.text_story[e] for e in story_edges])
+            noise_edge_list = puzzle.text_facts
             for d in noise_edge_list:
                 if type(d) != dict:
                     print(d)
@@ -113,8 +150,8 @@ def generate_rows(args, store, task_name):
             story = ''.join([story_edges[k] for k in story_keys])
             story_key_edges = [rb.get_edge_relation(k) for k in story_keys]
             all_edge_rows = []
-            all_edge_rows.append(puzzle['story'])
-            all_edge_rows.extend(puzzle['all_noise'])
+            all_edge_rows.append(puzzle.story)
+            all_edge_rows.extend(puzzle.all_noise)
 
             # Templating Logic
             # all_edge_rows = list of two list : [story, noise]
@@ -123,34 +160,22 @@ def generate_rows(args, store, task_name):
 
             templated_rows = []
             if args.use_mturk_template:
+                temp_user = TemplateUser(templates=templates, family=rb.anc.family_data)
                 for seq in all_edge_rows:
-                    #print(seq)
-                    # find all grouping combinations
-                    group_combs = comb_indexes(seq, args.template_length)
-                    #print(group_combs)
-                    temp_rows = []
-                    temp_user = TemplateUser(templates=templates, family=rb.anc.family_data)
-                    for group in group_combs:
-                        try:
-                            fcombs = ['-'.join([rb.get_edge_relation(edge) for edge in edge_group]) for edge_group in group]
-                            fentities = [[ent for edge in edge_group for ent in edge] for edge_group in group]
-                            prows = [temp_user.replace_template(edge_group, fentities[group_id])
-                                for group_id, edge_group in enumerate(fcombs)]
-                            temp_rows.append((group, prows))
-                        except:
-                            pass
-                    #print(len(temp_rows))
-                    if len(temp_rows) == 0:
-                        print(group_combs)
+                    # sample a grouping of the sequence whose groups all have templates
+                    def is_valid(edge_group):
+                        return temp_user.has_template('-'.join([rb.get_edge_relation(edge) for edge in edge_group]),
+                                                      [ent for edge in edge_group for ent in edge])
+                    group = sample_grouping(seq, args.template_length, is_valid)
+                    if group is None:
                         print(all_edge_rows)
                         print(seq)
-                        fcombs = ['-'.join([rb.get_edge_relation(edge) for edge in edge_group]) for edge_group in group]
-                        fentities = [[ent for edge in edge_group for ent in edge] for edge_group in group]
-                        prows = [temp_user.replace_template(edge_group, fentities[group_id], verbose=True)
-                                 for group_id, edge_group in enumerate(fcombs)]
-                    chosen_row = random.choice(temp_rows)
-                    #print('chosen row', chosen_row)
-                    templated_rows.append(chosen_row)
+                        raise NotImplementedError("template combination not found.")
+                    fcombs = ['-'.join([rb.get_edge_relation(edge) for edge in edge_group]) for edge_group in group]
+                    fentities = [[ent for edge in edge_group for ent in edge] for edge_group in group]
+                    prows = [temp_user.replace_template(edge_group, fentities[group_id])
+                             for group_id, edge_group in enumerate(fcombs)]
+                    templated_rows.append((group, prows))
 
                 templated_rows = [row[-1] for row in templated_rows]
                 # flatten
@@ -180,15 +205,16 @@ def generate_rows(args, store, task_name):
                     node_ct +=1
             story_keys_changed_id = [(node_id_dict[key[0]], node_id_dict[key[1]]) for key in story_keys]
             # add the query edges with respect to the same id
-            query_edge = (node_id_dict[puzzle['query'][0]], node_id_dict[puzzle['query'][1]])
-            text_question = rb.generate_question(puzzle['query'])
+            query_edge = (node_id_dict[puzzle.query[0]], node_id_dict[puzzle.query[1]])
+            text_question = rb.generate_question(puzzle.query)
             # also store the gender for postprocessing
             genders = ','.join(['{}:{}'.format(rb.anc.family_data[node_id].name,
                                                rb.anc.family_data[node_id].gender)
                                 for node_id in node_id_dict.keys()])
-            if puzzle['f_comb'] not in f_comb_count:
-                f_comb_count[puzzle['f_comb']] = 0
-            f_comb_count[puzzle['f_comb']] +=1
+            if puzzle.f_comb not in f_comb_count:
+                f_comb_count[puzzle.f_comb] = 0
+            f_comb_count[puzzle.f_comb] +=1
+            scheduler.update(puzzle.f_comb)
             stories_left -= 1
             if stories_left < 0:
                 break
@@ -197,16 +223,21 @@ def generate_rows(args, store, task_name):
             if args.use_mturk_template:
                 syn_story = story
                 story = ' '.join(templated_rows)
-            rows.append([pid, story, puzzle['query_text'], text_question, puzzle['target'], puzzle['text_target'],
-                         clean_story, puzzle['proof'], puzzle['f_comb'], task_name, story_keys_changed_id,
-                         story_key_edges, query_edge, genders, syn_story])
+            query_text, target = rb.format_query(puzzle)
+            yield [pid, story, query_text, text_question, target, puzzle.text_target,
+                         clean_story, rb.format_proof(puzzle.proof), puzzle.f_comb, task_name, story_keys_changed_id,
+                         story_key_edges, query_edge, genders, syn_story]
             pb.update(1)
         rb.reset_puzzle()
-        rb.anc.next_flip()
+        if bank:
+            # draw another tree of the bank for each round, they are closed already
+            rb = new_builder()
+            anc_num += 1
+        else:
+            rb.anc.next_flip()
     pb.close()
     print("{} ancestries created".format(anc_num))
     print("Number of unique patterns : {}".format(len(f_comb_count)))
-    return columns, rows
 
 
 def test_run(args):
@@ -234,14 +265,14 @@ def test_run(args):
 
 def main(args):
     store = Store(args)
-    header, rows = generate_rows(args, store)
-    df = pd.DataFrame(columns=header, data=rows)
     # split test train
-    msk = np.random.rand(len(df)) > args.test
-    train_df = df[msk]
-    test_df = df[~msk]
-    train_df.to_csv(args.output + '_train.csv')
-    test_df.to_csv(args.output + '_test.csv')
+    with make_sink(args.output + '_train.csv', COLUMNS) as train_sink, \
+            make_sink(args.output + '_test.csv', COLUMNS) as test_sink:
+        for row in generate_rows(args, store, 'task'):
+            if np.random.rand() > args.test:
+                train_sink.write(row)
+            else:
+                test_sink.write(row)
 
 if __name__ == '__main__':
     args = get_args()
@@ -1,7 +1,11 @@
 # main file which defines the tasks
-from clutrr.args import get_args
-from clutrr.generator import generate_rows
+from clutrr.args import get_args, EXPERIMENTAL_CLOSURES
+from clutrr.generator import generate_rows, COLUMNS
 from clutrr.store.store import Store
+from clutrr.store.templates import load_amt_templates
+from clutrr.utils.sinks import make_sink, SpillSink, read_spill
+from clutrr.utils.shards import sharded_rows, init_worker
+from clutrr.utils.checkpoint import Checkpoint
 import pandas as pd
 import glob
 import copy
@@ -10,12 +14,18 @@ import os
 import json
 import shutil
 import sys
+import itertools
+import collections
+import random
+import argparse
+import multiprocessing
 from nltk.tokenize import word_tokenize
 
 logPath = '../logs/'
 fileName = 'data'
 
 import logging
+import logging.handlers
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
@@ -30,8 +40,31 @@ logger = logging.getLogger()
 class Clutrr:
     def __init__(self, args):
         args = self._init_vars(args)
+        self.directory = None
+        self.row_ids = None # set when generating in shards, see ``run_task``
+        self.pool = None
+        self.checkpoint = None # set when generating in shards, to resume the run
         self.run_task(args)
 
+    def task_args(self, choice, args, num_rows=0, data_type='train'):
+        """
+        Args of a task choice
+        :param choice: <task_id>.<relation_length>
+        :param args:
+        :param num_rows:
+        :param data_type:
+        :return: args, task_name
+        """
+        args = copy.deepcopy(args)
+        args.num_rows = num_rows
+        args.data_type = data_type
+        task, relation_length = choice.split('.')
+        task_name = 'task_{}'.format(task)
+        task_method = getattr(self, task_name, lambda: "Task {} not implemented".format(choice))
+        args = task_method(args)
+        args.relation_length = int(relation_length)
+        return args, task_name + '.{}'.format(relation_length)
+
     def generate(self, choice, args, num_rows=0, data_type='train', multi=False):
         """
         Choose the task and the relation length
@@ -41,51 +74,76 @@ class Clutrr:
         :param num_rows:
         :param data_type:
         :param multi:
-        :return:
+        :return: (generator of rows, args). The rows are only generated when consumed, or
+        submitted right away when generating in shards with several workers
         """
-        args = copy.deepcopy(args)
-        args.num_rows = num_rows
-        args.data_type = data_type
         if not multi:
-            task, relation_length = choice.split('.')
-            task_name = 'task_{}'.format(task)
-            logger.info("mode : {}, task : {}, rel_length : {}".format(data_type, task_name, relation_length))
-            task_method = getattr(self, task_name, lambda: "Task {} not implemented".format(choice))
-            args = task_method(args)
-            args.relation_length = int(relation_length)
+            logger.info("mode : {}, task : {}".format(data_type, choice))
+            args, task_name = self.task_args(choice, args, num_rows, data_type)
+            if self.row_ids is not None:
+                return (sharded_rows(args, task_name, self.directory, self.row_ids, self.pool, self.checkpoint), args)
             store = Store(args)
-            return (generate_rows(args, store, task_name  + '.{}'.format(relation_length)), args)
+            return (generate_rows(args, store, task_name), args)
         else:
             rows = []
-            columns = []
             for ch in choice:
-                task, relation_length = ch.split('.')
-                task_name = 'task_{}'.format(task)
-                logger.info("mode : {}, task : {}, rel_length : {}".format(data_type, task_name, relation_length))
-                task_method = getattr(self, task_name, lambda: "Task {} not implemented".format(choice))
-                args = task_method(args)
-                args.relation_length = int(relation_length)
+                logger.info("mode : {}, task : {}".format(data_type, ch))
+                # each generator keeps its own args, as they are consumed later
+                args, task_name = self.task_args(ch, args, num_rows, data_type)
                 store = Store(args)
-                columns,r = generate_rows(args, store, task_name + '.{}'.format(relation_length))
-                rows.extend(r)
-            return ((columns, rows), args)
+                rows.append(generate_rows(args, store, task_name))
+            return (itertools.chain(*rows), args)
 
     def run_task(self, args):
         """
         Default dispatcher method
         """
-        train_rows = args.train_rows
-        test_rows = args.test_rows
+        if args.resume:
+            # continue as the run started, only the number of workers can change
+            self.checkpoint = Checkpoint.load(os.path.abspath(args.resume))
+            workers = args.workers
+            args = argparse.Namespace(**self.checkpoint.args)
+            if args.closure in EXPERIMENTAL_CLOSURES:
+                raise ValueError("The run to resume uses the experimental --closure {}, it cannot be resumed".format(
+                    args.closure))
+            args.workers = workers
+            self.directory = self.checkpoint.directory
+            logger.info("resuming {}, {} shards completed".format(self.directory, len(self.checkpoint.shards)))
+        else:
+            self.directory = self.make_directory(args)
+            if args.workers > 1 and args.seed is None:
+                args.seed = random.randrange(2 ** 32)
+            if args.seed is None:
+                logger.info("no --seed, the run is not checkpointed and cannot be resumed with --resume")
+                self.store(args.train_tasks.split(','), args.test_tasks.split(','), args, self.directory)
+                return
+            if args.closure in EXPERIMENTAL_CLOSURES:
+                logger.info("--closure {} is experimental, the run is not checkpointed and cannot be resumed".format(
+                    args.closure))
+            else:
+                self.checkpoint = Checkpoint(self.directory, vars(args))
+                self.checkpoint.save()
         train_choices = args.train_tasks.split(',')
         test_choices = args.test_tasks.split(',')
-        # training
-        train_datas = []
-        for t_choice in train_choices:
-            train_datas.append(self.generate(t_choice, args, num_rows=train_rows, data_type='train'))
-        test_datas = []
-        for t_choice in test_choices:
-            test_datas.append(self.generate(t_choice, args, num_rows=test_rows, data_type='test'))
-        self.store(train_datas, test_datas, args)
+        # generate in shards seeded from args.seed, the output does not depend on the number of workers
+        logger.info("generating in shards of {} rows with {} workers, seed {}".format(
+            args.shard_rows, args.workers, args.seed))
+        self.row_ids = itertools.count()
+        if args.workers > 1:
+            if args.use_mturk_template:
+                # compiled once here, the forked workers share it
+                load_amt_templates(args.template_file)
+            # logs of the workers are handled by the handlers of this process
+            queue = multiprocessing.Queue()
+            listener = logging.handlers.QueueListener(queue, *logger.handlers)
+            listener.start()
+            with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(queue,)) as pool:
+                self.pool = pool
+                self.store(train_choices, test_choices, args, self.directory)
+            self.pool = None
+            listener.stop()
+        else:
+            self.store(train_choices, test_choices, args, self.directory)
 
     def assign_name(self, args, task_name):
         """
@@ -97,97 +155,184 @@ class Clutrr:
         :return:
         """
         #hex = str(uuid.uuid4())[:8]
-        name = '{}_{}.csv'.format(task_name, args.data_type)
+        name = '{}_{}.{}'.format(task_name, args.data_type, args.output_format)
         return name
 
-    def store(self, train_data, test_data, args):
+    def make_directory(self, args):
+        """
+        Create the dataset folder, with a random name
+        :param args:
+        :return: directory
+        """
+        base_path = os.path.abspath(os.pardir)
+        # derive folder name as a random selection of characters
+        directory = ''
+        while True:
+            folder_name = 'data_{}'.format(str(uuid.uuid4())[:8])
+            directory = os.path.join(base_path, args.output_dir, folder_name)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+                break
+        return directory
+
+    def split_holdout(self, rows, train_sink, holdout_path, args):
         """
-        Take the dataset and do the following:
+        Hold out the least frequent patterns of a training task. The rows are spilled to
+        disk to count the patterns, then the frequent patterns are written to the
+        training sink, and the rest to the holdout file.
+        :param rows: generator of rows
+        :param train_sink: RowSink
+        :param holdout_path: file of the held out rows, or None to drop them
+        :param args:
+        :return: number of held out rows
+        """
+        f_comb_col = COLUMNS.index('f_comb')
+        f_comb_count = collections.Counter()
+        spill_path = os.path.join(self.directory, '.holdout.spill')
+        with SpillSink(spill_path, COLUMNS, args.chunk_size) as spill:
+            for row in rows:
+                f_comb_count[row[f_comb_col]] += 1
+                spill.write(row)
+        f_combs = [f_comb for f_comb, _ in f_comb_count.most_common()]
+        split = int(len(f_combs) * (1 - args.test_split))
+        f_comb_test = set(f_combs[split:])
+        logger.info("patterns in train : {}".format(split))
+        logger.info("patterns in test : {}".format(len(f_comb_test)))
+        num_holdout = 0
+        holdout_sink = make_sink(holdout_path, COLUMNS, args.output_format, args.chunk_size) if holdout_path else None
+        for row in read_spill(spill_path):
+            if row[f_comb_col] in f_comb_test:
+                num_holdout += 1
+                if holdout_sink:
+                    holdout_sink.write(row)
+            else:
+                train_sink.write(row)
+        if holdout_sink:
+            holdout_sink.close()
+        os.remove(spill_path)
+        return num_holdout
+
+    def file_done(self, name):
+        """
+        Whether a dataset file was completed by the run being resumed
+        :param name: dataset file name
+        :return: bool
+        """
+        return self.checkpoint is not None and self.checkpoint.file_done(name)
+
+    def complete_file(self, name, num_ids):
+        """
+        Record a completed dataset file in the checkpoint, with the number of row ids it used
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.complete_file(name, num_ids)
+
+    def skip_row_ids(self, num_ids):
+        """
+        Skip the row ids of a dataset file which is not written again, so that the
+        next files get the same ids as in the interrupted run
+        """
+        next(itertools.islice(self.row_ids, num_ids, num_ids), None)
+
+    def store(self, train_choices, test_choices, args, directory):
+        """
+        Generate the datasets and do the following:
         - Create a name for the files
-        - Create a folder and put the files in
+        - Create a folder and stream the rows into the files
         - Write the config in a file and put it in the folder
         - Compute the hash of the train and test files and store it in a file
-        :param train_data list of rows
-        :param test_data list of list of rows
+        :param train_choices: list of train tasks
+        :param test_choices: list of test tasks
+        :param directory: dataset folder, see ``make_directory``
         :return:
         """
-        train_tasks = args.train_tasks.split(',')
-        train_df = []
-        holdout = []
-        train_args = None
-        for i, td in enumerate(train_data):
-            train_rows, train_args = td
-            tdf = pd.DataFrame(columns=train_rows[0], data=train_rows[1])
-            if args.holdout == train_tasks[i]:
-                logger.info("holding out train {}".format(train_tasks[i]))
-                f_combs = tdf['f_comb'].value_counts().index.tolist()
-                split = int(len(f_combs) * (1 - args.test_split))
-                f_comb_train = f_combs[:split]
-                f_comb_test = f_combs[split:]
-                logger.info("patterns in train : {}".format(len(f_comb_train)))
-                logger.info("patterns in test : {}".format(len(f_comb_test)))
-                holdout.append(tdf[tdf['f_comb'].isin(f_comb_test)])
-                tdf = tdf[tdf['f_comb'].isin(f_comb_train)]
-            train_df.append(tdf)
-
-        train_df = pd.concat(train_df)
-        logger.info("Training rows : {}".format(len(train_df)))
         all_config = {}
-        train_fl_name = self.assign_name(train_args, args.train_tasks)
-        all_config['train_task'] = {args.train_tasks: train_fl_name}
         all_config['test_tasks'] = {}
-        test_fl_names = []
-        test_dfs = []
+        holdout_args = copy.deepcopy(args)
+        holdout_args.data_type = 'test'
+        # dataset files completed before the run was interrupted are not generated again
+        train_fl_name = self.assign_name(self.task_args(train_choices[0], args, args.train_rows, 'train')[0],
+                                         args.train_tasks)
+        train_done = self.file_done(train_fl_name)
+        # schedule all the tasks first, they only run upfront when generating with several workers
+        train_jobs = [(t_choice,) + self.generate(t_choice, args, num_rows=args.train_rows, data_type='train')
+                      if not train_done else (t_choice, None, self.task_args(t_choice, args, args.train_rows, 'train')[0])
+                      for t_choice in train_choices]
+        test_jobs = []
+        for t_choice in test_choices:
+            test_args = self.task_args(t_choice, args, args.test_rows, 'test')[0]
+            if args.holdout == t_choice or self.file_done(self.assign_name(test_args, t_choice)):
+                test_jobs.append((t_choice, None, test_args))
+            else:
+                test_jobs.append((t_choice,) + self.generate(t_choice, args, num_rows=args.test_rows, data_type='test'))
+        if train_done:
+            logger.info("{} already complete".format(train_fl_name))
+            self.skip_row_ids(self.checkpoint.files[train_fl_name])
+            train_args = train_jobs[-1][-1]
+        else:
+            train_sink = make_sink(os.path.join(directory, train_fl_name), COLUMNS,
+                                   args.output_format, args.chunk_size)
+            num_holdout = 0
+            for t_choice, rows, train_args in train_jobs:
+                if args.holdout == t_choice:
+                    logger.info("holding out train {}".format(t_choice))
+                    holdout_path = os.path.join(directory, self.assign_name(holdout_args, t_choice)) \
+                        if t_choice in test_choices else None
+                    num_holdout += self.split_holdout(rows, train_sink, holdout_path, args)
+                else:
+                    train_sink.write_rows(rows)
+            train_sink.close()
+            logger.info("Training rows : {}".format(train_sink.num_rows))
+            self.complete_file(train_fl_name, train_sink.num_rows + num_holdout)
+        all_config['train_task'] = {args.train_tasks: train_fl_name}
         all_config['args'] = {}
         all_config['args'][train_fl_name] = vars(train_args)
-        test_tasks = args.test_tasks.split(',')
-        for i,td in enumerate(test_data):
-            test_rows, test_args = td
-            tname = self.assign_name(test_args, test_tasks[i])
-            test_fl_names.append(tname)
+        for t_choice, rows, test_args in test_jobs:
+            tname = self.assign_name(test_args, t_choice)
             all_config[tname] = vars(test_args)
-            if args.holdout == test_tasks[i]:
-                logger.info("saving hold out test {}".format(test_tasks[i]))
-                test_dfs.append(holdout[0])
+            if args.holdout == t_choice:
+                # already written from the train rows
+                logger.info("saving hold out test {}".format(t_choice))
+            elif rows is None:
+                logger.info("{} already complete".format(tname))
+                self.skip_row_ids(self.checkpoint.files[tname])
             else:
-                test_dfs.append(pd.DataFrame(columns=test_rows[0], data=test_rows[1]))
-            all_config['test_tasks'][test_tasks[i]] = tname
+                with make_sink(os.path.join(directory, tname), COLUMNS, args.output_format, args.chunk_size) as sink:
+                    sink.write_rows(rows)
+                self.complete_file(tname, sink.num_rows)
+            all_config['test_tasks'][t_choice] = tname
 
-        base_path = os.path.abspath(os.pardir)
-        # derive folder name as a random selection of characters
-        directory = ''
-        while True:
-            folder_name = 'data_{}'.format(str(uuid.uuid4())[:8])
-            directory = os.path.join(base_path, args.output_dir, folder_name)
-            if not os.path.exists(directory):
-                os.makedirs(directory)
-                break
-        train_df.to_csv(os.path.join(directory, train_fl_name))
-        for i,test_fl_name in enumerate(test_fl_names):
-            test_df = test_dfs[i]
-            test_df.to_csv(os.path.join(directory, test_fl_name))
+        if self.checkpoint:
+            # the dataset is complete
+            self.checkpoint.clear()
         # dump config
         json.dump(all_config, open(os.path.join(directory, 'config.json'),'w'))
         shutil.make_archive(directory, 'zip', directory)
 
         logger.info("Created dataset in {}".format(directory))
-        self.analyze_data(directory)
+        self.analyze_data(directory, args.chunk_size)
         if args.mturk:
             self.keep_unique(directory)
 
 
-    def analyze_data(self, directory):
+    def analyze_data(self, directory, chunk_size=10000):
         all_files = glob.glob(os.path.join(directory,'*.csv'))
         for fl in all_files:
             logger.info("Analyzing file {}".format(fl))
-            df = pd.read_csv(fl)
-            df['word_len'] = df.story.apply(lambda x: len(word_tokenize(x)))
-            df['word_len_clean'] = df.clean_story.apply(lambda x: len(word_tokenize(x)))
-            print("Max words : ", df.word_len.max())
-            print("Min words : ", df.word_len.min())
+            word_len = []
+            word_len_clean = []
+            for df in pd.read_csv(fl, chunksize=chunk_size):
+                if len(df) == 0:
+                    continue
+                word_len.append(df.story.apply(lambda x: len(word_tokenize(x))).agg(['max', 'min']))
+                word_len_clean.append(df.clean_story.apply(lambda x: len(word_tokenize(x))).agg(['max', 'min']))
+            if len(word_len) == 0:
+                continue
+            print("Max words : ", max([w['max'] for w in word_len]))
+            print("Min words : ", min([w['min'] for w in word_len]))
             print("For clean story : ")
-            print("Max words : ", df.word_len_clean.max())
-            print("Min words : ", df.word_len_clean.min())
+            print("Max words : ", max([w['max'] for w in word_len_clean]))
+            print("Min words : ", min([w['min'] for w in word_len_clean]))
             #uniq_patterns = len(df['f_comb'].value_counts())
             #logger.info("-> {} rows".format(len(df)))
             #logger.info("-> {} unique patterns".format(uniq_patterns))
@@ -211,7 +356,7 @@ class Clutrr:
                 rd = df[df['f_comb'] == up].sample(num)
                 udf.append(rd)
             udf = pd.concat(udf)
-            udf.to_csv(fl)
+            udf.to_csv(fl, index=False)
 
 
 
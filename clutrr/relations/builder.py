@@ -2,9 +2,13 @@
 
 import random
 import itertools as it
-import copy
+import heapq
+import collections
+import numpy as np
 from clutrr.store.store import Store
-import uuid
+from clutrr.relations.matrix import MatrixClosure
+from clutrr.relations.cache import ClosureEntry, closure_cache, closure_mode
+from clutrr.relations.puzzle import Puzzle
 
 
 class RelationBuilder:
@@ -37,91 +41,117 @@ class RelationBuilder:
         self.sym_rules = self.rules['symmetric']
         self.eq_rules = self.rules['equivalence']
         self.relation_types = self.rules['relation_types']
-        self.comp_rules_inv = self._invert_rule(self.rules['compositional'])
-        self.inv_rules_inv = self._invert_rule(self.rules['inverse-equivalence'])
-        self.sym_rules_inv = self._invert_rule(self.rules['symmetric'])
-        self.eq_rules_inv = self._invert_rule(self.rules['equivalence'])
+        self.comp_rules_inv = store.compiled.inverted_rules['compositional']
+        self.inv_rules_inv = store.compiled.inverted_rules['inverse-equivalence']
+        self.sym_rules_inv = store.compiled.inverted_rules['symmetric']
+        self.eq_rules_inv = store.compiled.inverted_rules['equivalence']
         self.relations_obj = store.relations_store
+        self.templates = store.surface_templates
         self.boundary = args.boundary
         self.num_rel = args.relation_length
         self.puzzles = {}
         self.puzzle_ct = 0
-        self.expansions = {} # (a,b) : [list]
+        self.expansions = collections.OrderedDict() # (a,b) : ([list], cycle), computed on demand
+        self.expansion_cache_size = args.expansion_cache
+        self.shared_expansions = {} # (a,b) : [list], precomputed expansions of the closure entry, see ``precompute_expansions``
+        self.edge_pool = None # arrays of the x and y of the edges (x,y) with x < y, to sample disconnected facts from
+        self.derivations = {} # ((a,b), k) : number of proof trees, see ``count_derivations``
         # save the edges which are used already
         self.done_edges = set()
-        self.apply_almost_complete()
-        self.precompute_expansions(list(self.anc.family.keys()))
+        self.close_family()
 
-    def _invert_rule(self, rule):
-        """
-        Given a rule, invert it to be RHS:LHS
-        :param rule:
-        :return:
-        """
-        inv_rules = {}
-        for tp, rules in rule.items():
-            inv_rules[tp] = {}
-            for key, val in rules.items():
-                if type(val) == str:
-                    if val not in inv_rules[tp]:
-                        inv_rules[tp][val] = []
-                    inv_rules[tp][val].append(key)
-                else:
-                    for k2, v2 in val.items():
-                        if v2 not in inv_rules[tp]:
-                            inv_rules[tp][v2] = []
-                        inv_rules[tp][v2].append((key, k2))
-        return inv_rules
-
-    def invert_rel(self, rel_type='family'):
+    def invert_rel(self, edges, rel_type='family'):
         """
         Invert the relations
+        :param edges: edges to apply the rule on
         :return:
         """
         if rel_type not in self.inv_rules:
             return None
-        inv_family = copy.deepcopy(self.anc.family)
-        for edge, rel in self.anc.family.items():
-            relation = rel[rel_type]
+        updates = []
+        for edge in edges:
+            relation = self.anc.relation(edge, rel_type)
             if relation in self.inv_rules[rel_type]:
-                inv_rel = self.inv_rules[rel_type][relation]
-                if (edge[1], edge[0]) not in inv_family:
-                    inv_family[(edge[1], edge[0])] = {}
-                inv_family[(edge[1], edge[0])][rel_type] = inv_rel
-        self.anc.family = inv_family
+                updates.append(((edge[1], edge[0]), self.inv_rules[rel_type][relation]))
+        return self._update_rels(updates, rel_type)
 
-    def equivalence_rel(self, rel_type='family'):
+    def equivalence_rel(self, edges, rel_type='family'):
         """
         Use equivalence relations
+        :param edges: edges to apply the rule on
         :return:
         """
         if rel_type not in self.eq_rules:
             return None
-        n_family = copy.deepcopy(self.anc.family)
-        for edge, rel in self.anc.family.items():
-            relation = rel[rel_type]
+        updates = []
+        for edge in edges:
+            relation = self.anc.relation(edge, rel_type)
             if relation in self.eq_rules[rel_type]:
-                eq_rel = self.eq_rules[rel_type][relation]
-                n_family[(edge[0],edge[1])][rel_type] = eq_rel
-        self.anc.family = n_family
+                updates.append((edge, self.eq_rules[rel_type][relation]))
+        return self._update_rels(updates, rel_type)
 
-    def symmetry_rel(self, rel_type='family'):
+    def symmetry_rel(self, edges, rel_type='family'):
         """
-        Use equivalence relations
+        Use symmetric relations
+        :param edges: edges to apply the rule on
         :return:
         """
         if rel_type not in self.sym_rules:
             return None
-        n_family = copy.deepcopy(self.anc.family)
-        for edge, rel in self.anc.family.items():
-            relation = rel[rel_type]
+        updates = []
+        for edge in edges:
+            relation = self.anc.relation(edge, rel_type)
             if relation in self.sym_rules[rel_type]:
-                sym_rel = self.sym_rules[rel_type][relation]
-                if (edge[1], edge[0]) not in n_family:
-                    n_family[(edge[1], edge[0])] = {}
-                n_family[(edge[1], edge[0])][rel_type] = sym_rel
-        self.anc.family = n_family
+                updates.append(((edge[1], edge[0]), self.sym_rules[rel_type][relation]))
+        return self._update_rels(updates, rel_type)
 
+    def _update_rels(self, updates, rel_type='family'):
+        """
+        Apply a batch of (edge, relation) updates, computed from the same snapshot
+        :param updates:
+        :return: list of edges which were added or changed
+        """
+        changed = []
+        for edge, relation in updates:
+            if self._set_rel(edge, relation, rel_type):
+                changed.append(edge)
+        return changed
+
+    def _set_rel(self, edge, relation, rel_type='family'):
+        """
+        Set the relation of an edge in the ancestry, and keep the closure state up to date:
+            - rank of insertion of each edge
+            - dirty edges, on which the unary rules are yet to be applied
+        :param edge: (x,y)
+        :param relation:
+        :return: True if the edge was added or changed
+        """
+        is_new = edge not in self.anc.family
+        if not self.anc.set_relation(edge, relation, rel_type):
+            return False
+        if is_new:
+            self._rank[edge] = len(self._rank)
+            row, col = self._cursor
+            if edge[0] == row and edge[1] > col:
+                heapq.heappush(self._row_heap, edge[1])
+        self._dirty.add(edge)
+        return True
+
+    def _apply_unary_rules(self):
+        """
+        Apply inverse, equivalence and symmetric rules, once, on the edges added or
+        changed since the last time. On all other edges these rules have already been
+        applied and would not change the graph.
+        :return:
+        """
+        if not self._dirty:
+            return
+        edges = self._dirty
+        self._dirty = set()
+        # each pass reads the graph left by the previous one
+        edges.update(self.invert_rel(sorted(edges, key=self._rank.__getitem__)) or [])
+        edges.update(self.equivalence_rel(sorted(edges, key=self._rank.__getitem__)) or [])
+        self.symmetry_rel(sorted(edges, key=self._rank.__getitem__))
 
     def compose_rel(self, edge_1, edge_2, rel_type='family', verbose=False):
         """
@@ -141,72 +171,182 @@ class RelationBuilder:
             n_edge = (edge_1[0], edge_2[1])
             if n_edge not in self.anc.family and \
                     (edge_1 in self.anc.family and
-                     self.anc.family[edge_1][rel_type] in self.comp_rules[rel_type]):
+                     self.anc.relation(edge_1, rel_type) in self.comp_rules[rel_type]):
                 if edge_2 in self.anc.family and \
-                        self.anc.family[edge_2][rel_type] in self.comp_rules[rel_type][self.anc.family[edge_1][rel_type]]:
-                    n_rel = self.comp_rules[rel_type][self.anc.family[edge_1][rel_type]][self.anc.family[edge_2][rel_type]]
-                    if n_edge not in self.anc.family:
-                        self.anc.family[n_edge] = {}
-                    self.anc.family[n_edge][rel_type] = n_rel
+                        self.anc.relation(edge_2, rel_type) in self.comp_rules[rel_type][self.anc.relation(edge_1, rel_type)]:
+                    n_rel = self.comp_rules[rel_type][self.anc.relation(edge_1, rel_type)][self.anc.relation(edge_2, rel_type)]
+                    self._set_rel(n_edge, n_rel, rel_type)
                     if verbose:
                         print(edge_1, edge_2, n_rel)
                     return n_edge
         return None
 
-    def almost_complete(self,edge):
+    def almost_complete(self, edge):
         """
         Build an almost complete graph by iteratively applying the rules
-        Recursively apply rules and invert
+        Depth first, every newly composed edge is in turn composed with its
+        neighbours. Uses an explicit stack instead of recursion.
+        :param edge: (x,y)
         :return:
         """
-        # apply symmetric, equivalence and inverse rules
-        self.invert_rel()
-        self.equivalence_rel()
-        self.symmetry_rel()
-        # apply compositional rules
-        keys = list(self.anc.family.keys())
-        edge_1 = [self.compose_rel(e, edge) for e in keys if e[1] == edge[0]]
-        edge_2 = [self.compose_rel(edge, e) for e in keys if e[0] == edge[1]]
-        edge_1 = list(filter(None.__ne__, edge_1))
-        edge_2 = list(filter(None.__ne__, edge_2))
-        for e in edge_1:
-            self.almost_complete(e)
-        for e in edge_2:
-            self.almost_complete(e)
+        stack = [iter([edge])]
+        while stack:
+            edge = next(stack[-1], None)
+            if edge is None:
+                stack.pop()
+                continue
+            # apply symmetric, equivalence and inverse rules
+            self._apply_unary_rules()
+            # apply compositional rules, only against the neighbours of the edge
+            in_nodes = list(self.anc.in_nodes(edge[0]))
+            out_nodes = list(self.anc.out_nodes(edge[1]))
+            edge_1 = [self.compose_rel((z, edge[0]), edge) for z in in_nodes]
+            edge_2 = [self.compose_rel(edge, (edge[1], z)) for z in out_nodes]
+            stack.append(iter(list(filter(None.__ne__, edge_1 + edge_2))))
 
     def apply_almost_complete(self):
         """
-        For each edge apply ``almost_complete``
+        For each edge apply ``almost_complete``, in the order of the node pairs
         :return:
         """
         print("Almost completing the family graph with {} nodes...".format(len(self.anc.family_data)))
+        self._rank = {edge: rank for rank, edge in enumerate(self.anc.family)}
+        self._cursor = (-1, -1)
+        self._row_heap = []
+        self._dirty = set(self.anc.family.keys())
         for i in range(len(self.anc.family_data)):
-            for j in range(len(self.anc.family_data)):
+            # pairs (i, j) which are not edges are no-ops, so only visit the edges of
+            # node i. edges (i, j) composed while visiting the row are pushed in the heap
+            self._row_heap = sorted(set(self.anc.out_nodes(i)))
+            while self._row_heap:
+                j = heapq.heappop(self._row_heap)
+                self._cursor = (i, j)
                 if i != j:
                     self.almost_complete((i, j))
+        self._cursor = (-1, -1)
+        self._apply_unary_rules()
         print("Initial family tree created with {} edges".format(
             len(set([k for k, v in self.anc.family.items()]))))
 
-    def build(self):
+    def close_family(self, tp='family'):
+        """
+        Close the family graph. The closure only depends on the skeleton, so it is
+        computed once per distinct skeleton and reused from ``closure_cache`` (and
+        from disk across runs, with ``--closure_cache_dir``), along with the expansions.
+        :return:
+        """
+        cache_dir = self.args.closure_cache_dir
+        signature = closure_cache.signature(self.anc, self.rules, closure_mode(self.args), tp)
+        entry = closure_cache.get(signature, cache_dir)
+        if entry is None:
+            if self.args.closure == 'matrix':
+                print("Almost completing the family graph with {} nodes...".format(len(self.anc.family_data)))
+                self.apply_matrix_closure(tp)
+            elif self.args.closure == 'bounded':
+                print("Closing the family graph with {} nodes up to depth {}...".format(
+                    len(self.anc.family_data), self.num_rel))
+                self.apply_bounded_closure(self.num_rel, tp)
+            else:
+                self.apply_almost_complete()
+            src, dst, codes, relations = self.anc.edge_table.arrays(tp)
+            entry = ClosureEntry(src.copy(), dst.copy(), codes.copy(), list(relations))
+            self.shared_expansions = entry.expansions
+            if cache_dir:
+                # other runs may expand any edge, so store all the expansions
+                self.precompute_expansions(list(self.anc.family.keys()), tp)
+            closure_cache.put(signature, entry, cache_dir)
+        else:
+            self.anc.load_relations(entry.src, entry.dst, entry.codes, entry.relations, tp)
+            print("Reusing the closed family tree with {} edges".format(len(self.anc.family)))
+        self.shared_expansions = entry.expansions
+        # the closed graph is only read from now on
+        self.anc.freeze(tp)
+
+    def apply_matrix_closure(self, rel_type='family'):
+        """
+        Close the graph with batched passes over the relation matrix of the ancestry.
+        Much faster than ``almost_complete`` on large trees. When two compositions disagree
+        (eg. in-laws), the first derivation within a pass is kept, so these relations and
+        the edges composed from them may differ from the depth first closure.
+        :return:
+        """
+        codes = self.store.compiled.relation_codes[rel_type]
+        matrix = self.anc.to_matrix(codes, rel_type)
+        MatrixClosure(codes).close(matrix)
+        self.anc.from_matrix(matrix, codes, rel_type)
+        print("Initial family tree created with {} edges".format(len(self.anc.family)))
+
+    def apply_bounded_closure(self, depth, rel_type='family'):
+        """
+        Close the graph up to a proof depth, ie. only derive the edges composed from at most
+        ``depth`` simulated edges: the target of a story of k edges is within k hops.
+        Edges are derived by increasing depth, an edge of depth d composing an edge of depth d1
+        with an edge of depth d - d1, so that each edge gets its shortest proof. Inverse,
+        equivalence and symmetric rules keep the depth of the edge they apply on.
+        As in ``apply_matrix_closure``, when two compositions disagree (eg. in-laws) the
+        shortest is kept, so these relations may differ from the depth first closure.
+        :param depth: max proof depth
+        :return:
+        """
+        self._rank = {edge: rank for rank, edge in enumerate(self.anc.family)}
+        self._cursor = (-1, -1)
+        self._row_heap = []
+        self._dirty = set(self.anc.family.keys())
+        self._apply_unary_rules()
+        layers = [[], list(self.anc.family)] # depth : edges of the depth
+        depths = dict.fromkeys(layers[1], 1)
+        deepest = 1 # deepest non empty layer, no edge can be deeper than twice its depth
+        for d in range(2, depth + 1):
+            if d > 2 * deepest:
+                break
+            for d1 in range(1, d):
+                for edge_1 in layers[d1]:
+                    for y in list(self.anc.out_nodes(edge_1[1])):
+                        if depths.get((edge_1[1], y)) == d - d1:
+                            self.compose_rel(edge_1, (edge_1[1], y), rel_type)
+            self._apply_unary_rules()
+            # edges are inserted in order, the new ones come after the ones of lower depth
+            layers.append(list(it.islice(self.anc.family, len(depths), None)))
+            depths.update(dict.fromkeys(layers[d], d))
+            if layers[d]:
+                deepest = d
+        print("Initial family tree created with {} edges".format(len(self.anc.family)))
+
+    def build(self, budget=None):
         """
         Build the stories and targets for the current family configuration
         and save it in memory. These will be used later for post-processing
-        :param num_rel:
+
+        The edges derived from are kept in ``done_edges``, so that the next builds, after
+        a gender flip, derive from other edges. Once all the edges are done, they are all
+        available again.
+        :param budget: if given, visit the edges in random order and stop after this many
+         puzzles. Otherwise derive from all the edges which are not done
         :return:
         """
-        available_edges = set([k for k, v in self.anc.family.items()]) - self.done_edges
+        available_edges = set(self.anc.family) - self.done_edges
+        if len(available_edges) == 0:
+            # all the edges were derived from already, start over
+            self.done_edges = set()
+            available_edges = set(self.anc.family)
+        if budget is not None:
+            available_edges = [edge for edge in self.anc.family if edge in available_edges]
+            random.shuffle(available_edges)
         #print("Available edges to derive backwards - {}".format(len(available_edges)))
+        num_puzzles = 0
         for edge in available_edges:
-            story, proof_trace = self.derive([edge], k=self.num_rel-1)
+            if budget is not None and num_puzzles >= budget:
+                break
+            self.done_edges.add(edge)
+            if self.args.exhaustive:
+                story, proof_trace = self.sample_derivation(edge)
+            else:
+                story, proof_trace = self.derive([edge], k=self.num_rel-1)
             if len(story) == self.num_rel:
-                id = str(uuid.uuid4())
-                self.puzzles[id] = {
-                    'edge': edge,
-                    'story': story,
-                    'proof': proof_trace
-                }
-                self.puzzles[id]['f_comb'] = '-'.join([self._get_edge_rel(x)['rel'] for x in story])
+                puzzle = Puzzle(edge, story, proof_trace, '-'.join([self._get_edge_rel(x)['rel'] for x in story]))
+                self.puzzles[puzzle.id] = puzzle
                 self.puzzle_ct += 1
+                num_puzzles += 1
         if len(self.puzzles) == 0:
             print("No puzzles could be generated with this current set of arguments. Consider increasing the family tree.")
             return False
@@ -222,16 +362,16 @@ class RelationBuilder:
         """Get unique patterns in this puzzle"""
         f_comb_count = {}
         for pid, puzzle in self.puzzles.items():
-            if puzzle['f_comb'] not in f_comb_count:
-                f_comb_count[puzzle['f_comb']] = 0
-            f_comb_count[puzzle['f_comb']] += 1
+            if puzzle.f_comb not in f_comb_count:
+                f_comb_count[puzzle.f_comb] = 0
+            f_comb_count[puzzle.f_comb] += 1
         return set(f_comb_count.keys())
 
 
     def _value_counts(self):
         pztype = {}
         for pid, puzzle in self.puzzles.items():
-            f_comb = puzzle['f_comb']
+            f_comb = puzzle.f_comb
             if f_comb not in pztype:
                 pztype[f_comb] = []
             pztype[f_comb].append(pid)
@@ -266,6 +406,47 @@ class RelationBuilder:
             for pid in not_keep:
                 del self.puzzles[pid]
 
+    def keep_puzzles(self, puzzle_ids):
+        """
+        Only keep the given puzzles, in the given order. Used to drop the puzzles which were
+        not selected by the pattern scheduler before generating their facts and text
+        :param puzzle_ids: list of puzzle ids
+        :return:
+        """
+        self.puzzles = {pid: self.puzzles[pid] for pid in puzzle_ids}
+
+    def sample_disconnected(self, nodes, num_edges, max_tries=10):
+        """
+        Sample distinct edges which do not touch any of the given nodes. Edges are drawn from
+        the edge pool of the tree and rejected if they touch the nodes, and only if that fails
+        too often, the edges touching the nodes are masked out of the pool arrays.
+        :param nodes: set of nodes, usually of the story
+        :param num_edges: number of edges to sample
+        :param max_tries: number of draws per edge before masking
+        :return: list of at most num_edges edges
+        """
+        if self.edge_pool is None:
+            # every pair of connected nodes once, read from the arrays of the edge table
+            src, dst, _, _ = self.anc.edge_table.arrays()
+            pool = np.flatnonzero(src < dst)
+            self.edge_pool = (src[pool], dst[pool])
+        pool_x, pool_y = self.edge_pool
+        sampled = []
+        for _ in range(max_tries * num_edges):
+            if len(sampled) == num_edges or len(pool_x) == 0:
+                break
+            i = random.randrange(len(pool_x))
+            x, y = int(pool_x[i]), int(pool_y[i])
+            if x not in nodes and y not in nodes and (x, y) not in sampled:
+                sampled.append((x, y))
+        if len(sampled) < num_edges:
+            touched = np.zeros(len(self.anc.family_data), dtype=bool)
+            touched[list(nodes)] = True
+            possible = np.flatnonzero(~(touched[pool_x] | touched[pool_y]))
+            sampled = [(int(pool_x[possible[i]]), int(pool_y[possible[i]]))
+                       for i in random.sample(range(len(possible)), min(num_edges, len(possible)))]
+        return sampled
+
     def add_facts(self):
         """
             For each stored puzzle, add different types of facts
@@ -283,12 +464,12 @@ class RelationBuilder:
             if self.args.noise_support:
                 # Supporting facts
                 # A <-> B <-> C ==> A <-> D <-> C , A <-> D <-> B <-> C
-                story = puzzle['story']
+                story = puzzle.story
                 extra_story = []
                 for se in story:
                     e_pair = self.expand_new(se)
                     if e_pair:
-                        if puzzle['edge'] not in e_pair:
+                        if puzzle.edge not in e_pair:
                             extra_story.append(tuple(e_pair))
                 if len(extra_story) == 0:
                     mark_ids_for_deletion.append(puzzle_id)
@@ -299,12 +480,13 @@ class RelationBuilder:
                     # untuple the extra stories
                     extra_story = [k for e in extra_story for k in e]
                     self._test_supporting(story, extra_story)
-                self.puzzles[puzzle_id]['fact_1'] = extra_story
+                puzzle.facts['fact_1'] = extra_story
             if self.args.noise_irrelevant:
                 # Irrelevant facts
                 # A <-> B <-> C ==> A <-> D <-> E
                 # Must have only one common node with the story
-                story = puzzle['story']
+                story = puzzle.story
+                story_nodes = self._unique_nodes(story)
                 num_edges = len(story)
                 sampled_edge = random.choice(story)
                 extra_story = []
@@ -316,7 +498,7 @@ class RelationBuilder:
                         while len(extra_story) == 0 and (tuple(pair) not in seen_pairs):
                             seen_pairs.add(tuple(pair))
                             for e in pair:
-                                if e != puzzle['edge'] and not self._subset(story, [e], k=2):
+                                if e != puzzle.edge and not (e[0] in story_nodes and e[1] in story_nodes):
                                     extra_story.append(e)
                                     sampled_edge = e
                                     break
@@ -329,25 +511,22 @@ class RelationBuilder:
                     # length restriction should be k+1 than the current k
                     extra_story = random.sample(extra_story, min(len(extra_story), len(story) // 2))
                     self._test_irrelevant(story, extra_story)
-                    self.puzzles[puzzle_id]['fact_2'] = extra_story
+                    puzzle.facts['fact_2'] = extra_story
             if self.args.noise_disconnected:
                 # Disconnected facts
-                story = puzzle['story']
-                nodes_story = set([y for x in list(story) for y in x])
-                nodes_not_in_story = set(self.anc.family_data.keys()) - nodes_story
-                possible_edges = [(x,y) for x,y in it.combinations(list(nodes_not_in_story), 2) if (x,y) in self.anc.family]
+                story = puzzle.story
                 num_edges = random.choice(range(1, (len(story) // 2) + 1))
-                possible_edges = random.sample(possible_edges, min(num_edges, len(possible_edges)))
+                possible_edges = self.sample_disconnected(self._unique_nodes(story), num_edges)
                 if len(possible_edges) == 0:
                     mark_ids_for_deletion.append(puzzle_id)
                 self._test_disconnected(story, possible_edges)
-                self.puzzles[puzzle_id]['fact_3'] = possible_edges
+                puzzle.facts['fact_3'] = possible_edges
             # Future work
             # TODO: problem for generating clean graphs task 6
             # solution here is to add an edge considering the entity "Facebook" an actor
             # if self.args.noise_attributes:
             #     num_attr = random.choice(range(1, len(self.store.attribute_store)+1))
-            #     story = puzzle['story']
+            #     story = puzzle.story
             #     ents = [se[0] for se in story]
             #     ents.append(story[-1][-1])
             #     noise = {}
@@ -370,34 +549,100 @@ class RelationBuilder:
         Given a list of edges, precompute the one level expansions on all of them
         Given (x,y) -> get (x,z), (z,y) s.t. it follows our set of rules
         Store the expansions as a list : (x,y) : [[(x,a),(a,y)], [(x,b),(b,y)] ... ]
+
+        Computed as a hash join on z of the edges grouped by relation, (x, rel_a, z) and
+        (z, rel_b, y), for each rule (rel_a, rel_b) : rel. Expansions are otherwise
+        computed lazily by ``expand_new``, so this is only needed to warm up the cache, and to
+        save all the expansions along with the closure (``--closure_cache_dir`` and tree banks).
+        Precomputed expansions are kept in ``shared_expansions``, outside of the bounded cache.
         :param edge_list:
         :return:
         """
-        for edge in edge_list:
-            relation = self.anc.family[edge][tp]
-            if relation not in self.comp_rules_inv[tp]:
-                continue
-            rules = list(self.comp_rules_inv[tp][relation])
+        edge_list = [edge for edge in edge_list if edge not in self.shared_expansions]
+        targets = set(edge_list)
+        # group the edges by relation, keyed by the join node z
+        by_dst = {}  # rel_a : z : [x]
+        by_src = {}  # rel_b : z : [y]
+        for edge, rel in self.anc.relations(tp):
+            by_dst.setdefault(rel, {}).setdefault(edge[1], []).append(edge[0])
+            by_src.setdefault(rel, {}).setdefault(edge[0], []).append(edge[1])
+        middle = {}  # (x, y, rule) : [z]
+        for relation, rules in self.comp_rules_inv[tp].items():
             for rule in rules:
-                for node in self.anc.family_data.keys():
-                    e1 = (edge[0], node)
-                    e2 = (node, edge[1])
-                    if e1 in self.anc.family and self.anc.family[e1][tp] == rule[0] \
-                            and e2 in self.anc.family and self.anc.family[e2][tp] == rule[1]:
-                        new_edge_pair = [e1, e2]
-                        if edge not in self.expansions:
-                            self.expansions[edge] = []
-                        self.expansions[edge].append(new_edge_pair)
-            self.expansions[edge] = it.cycle(self.expansions[edge])
+                right = by_src.get(rule[1], {})
+                for z, xs in by_dst.get(rule[0], {}).items():
+                    for x in xs:
+                        for y in right.get(z, []):
+                            if (x, y) in targets and self.anc.relation((x, y), tp) == relation:
+                                middle.setdefault((x, y, rule), []).append(z)
+        for edge in edge_list:
+            relation = self.anc.relation(edge, tp)
+            expansions = []
+            for rule in self.comp_rules_inv[tp].get(relation, []):
+                for node in sorted(middle.get((edge[0], edge[1], rule), [])):
+                    expansions.append([(edge[0], node), (node, edge[1])])
+            self.shared_expansions[edge] = expansions
+            self._cache_expansions(edge, expansions)
+
+    def _cache_expansions(self, edge, expansions):
+        """
+        Keep the expansions of an edge in the bounded cache, evicting the least recently used
+        edge. An evicted edge is recomputed on its next use, restarting its rotation.
+        :param edge:
+        :param expansions: list of expansions
+        :return:
+        """
+        self.expansions[edge] = (expansions, it.cycle(expansions))
+        if len(self.expansions) > self.expansion_cache_size:
+            self.expansions.popitem(last=False)
+
+    def get_expansions(self, edge, tp='family'):
+        """
+        Get all the expansions of an edge, computing them on first use
+        :param edge:
+        :return: list of expansions [[(x,a),(a,y)], [(x,b),(b,y)] ... ]
+        """
+        if edge in self.expansions:
+            self.expansions.move_to_end(edge)
+            return self.expansions[edge][0]
+        expansions = self.shared_expansions.get(edge)
+        if expansions is None:
+            relation = self.anc.relation(edge, tp)
+            expansions = []
+            for rule in self.comp_rules_inv[tp].get(relation, []):
+                for node in self._middle_nodes(edge, rule):
+                    expansions.append([(edge[0], node), (node, edge[1])])
+        self._cache_expansions(edge, expansions)
+        return expansions
+
+    def _middle_nodes(self, edge, rule):
+        """
+        Given (x,y) and a rule (rel_a, rel_b), find the nodes z such that (x,z) is rel_a
+        and (z,y) is rel_b, using the relation index of the ancestry
+        :param edge: (x,y)
+        :param rule: (rel_a, rel_b)
+        :return: sorted list of node ids
+        """
+        nodes_a = self.anc.neighbours(edge[0], rule[0])
+        nodes_b = self.anc.neighbours(edge[1], rule[1], incoming=True)
+        return sorted(set(nodes_a).intersection(nodes_b))
 
     def expand_new(self, edge, tp='family'):
-        relation = self.anc.family[edge][tp]
+        """
+        Given an edge, return its next expansion, rotating over all of them
+        :param edge:
+        :return: [(x,z), (z,y)] or None
+        """
+        relation = self.anc.relation(edge, tp)
         if relation not in self.comp_rules_inv[tp]:
             return None
-        if edge in self.expansions:
-            return self.expansions[edge].__next__()
-        else:
+        expansions = self.get_expansions(edge, tp)
+        if len(expansions) == 0:
             return None
+        if edge in self.expansions:
+            return self.expansions[edge][1].__next__()
+        # not kept with --expansion_cache 0, so there is no rotation to resume
+        return expansions[0]
 
     def expand(self, edge, tp='family'):
         """
@@ -409,19 +654,16 @@ class RelationBuilder:
         :param k: if k == 0, stop recursing
         :return:
         """
-        relation = self.anc.family[edge][tp]
+        relation = self.anc.relation(edge, tp)
         if relation not in self.comp_rules_inv[tp]:
             return None
         rules = list(self.comp_rules_inv[tp][relation])
         while len(rules) > 0:
             rule = random.choice(rules)
             rules.remove(rule)
-            for node in self.anc.family_data.keys():
-                e1 = (edge[0], node)
-                e2 = (node, edge[1])
-                if e1 in self.anc.family and self.anc.family[e1][tp] == rule[0] \
-                        and e2 in self.anc.family and self.anc.family[e2][tp] == rule[1]:
-                    return [e1, e2]
+            nodes = self._middle_nodes(edge, rule)
+            if len(nodes) > 0:
+                return [(edge[0], nodes[0]), (nodes[0], edge[1])]
         return None
 
     def derive(self, edge_list, k=3):
@@ -429,7 +671,7 @@ class RelationBuilder:
         Given a list of edges, expand elements from the edge until we reach k
         :param edge_list:
         :param k:
-        :return:
+        :return: edge_list, proof_trace as a list of (edge, e1, e2)
         """
         proof_trace = []
         seen = set()
@@ -447,23 +689,127 @@ class RelationBuilder:
                 edge_list.insert(pos, ex_e[0])
                 edge_list.remove(e)
                 #edge_list.extend(ex_e)
-                # format proof into human readable form
-                e = self._format_edge_rel(e)
-                ex_e = [self._format_edge_rel(x) for x in ex_e]
-                proof_trace.append({e:ex_e})
+                # formatted into human readable form by `format_proof`
+                proof_trace.append((e, ex_e[0], ex_e[-1]))
                 k = k-1
         return edge_list, proof_trace
 
+    def count_derivations(self, edge, k):
+        """
+        Number of proof trees rooted at ``edge`` with a story of k edges, counting the trees
+        which reuse an edge as well. Memoized in ``self.derivations``, and used to prune
+        and to sample the enumeration.
+        :param edge: (x,y)
+        :param k:
+        :return: int
+        """
+        if k == 1:
+            return 1
+        key = (edge, k)
+        if key not in self.derivations:
+            self.derivations[key] = sum([self.count_derivations(e1, k1) * self.count_derivations(e2, k - k1)
+                                         for e1, e2 in self.get_expansions(edge) for k1 in range(1, k)])
+        return self.derivations[key]
+
+    def _proof_trees(self, edge, k, used=frozenset()):
+        """
+        Depth first enumeration of the valid proof trees rooted at ``edge`` with a story
+        of k edges. A proof tree is valid if all its edges, in either direction, are distinct,
+        which is what ``derive`` enforces with ``seen``.
+        :param edge: (x,y)
+        :param k:
+        :param used: undirected edges already used by the rest of the tree
+        :return: generator of (story, proof, used), where proof is a tuple of (edge, e1, e2)
+        """
+        root = (min(edge), max(edge))
+        if root in used or self.count_derivations(edge, k) == 0:
+            return
+        used = used | {root}
+        if k == 1:
+            yield (edge,), (), used
+            return
+        for e1, e2 in self.get_expansions(edge):
+            for k1 in range(1, k):
+                if self.count_derivations(e1, k1) == 0 or self.count_derivations(e2, k - k1) == 0:
+                    continue
+                for l_story, l_proof, l_used in self._proof_trees(e1, k1, used):
+                    for r_story, r_proof, r_used in self._proof_trees(e2, k - k1, l_used):
+                        yield l_story + r_story, ((edge, e1, e2),) + l_proof + r_proof, r_used
+
+    def _sample_proof_tree(self, edge, k):
+        """
+        Sample a proof tree, valid or not, uniformly using ``count_derivations``
+        :return: story, proof
+        """
+        if k == 1:
+            return (edge,), ()
+        choices = [(e1, e2, k1) for e1, e2 in self.get_expansions(edge) for k1 in range(1, k)]
+        weights = [self.count_derivations(e1, k1) * self.count_derivations(e2, k - k1) for e1, e2, k1 in choices]
+        e1, e2, k1 = random.choices(choices, weights=weights)[0]
+        l_story, l_proof = self._sample_proof_tree(e1, k1)
+        r_story, r_proof = self._sample_proof_tree(e2, k - k1)
+        return l_story + r_story, ((edge, e1, e2),) + l_proof + r_proof
+
+    def format_proof(self, proof):
+        """
+        Format a proof trace of node ids into human readable form
+        :param proof: list of (edge, e1, e2)
+        :return: list of {(name, rel, name) : [(name, rel, name), (name, rel, name)]}
+        """
+        return [{self._format_edge_rel(e): [self._format_edge_rel(e1), self._format_edge_rel(e2)]}
+                for e, e1, e2 in proof]
+
+    def enumerate_derivations(self, edge, k=None):
+        """
+        Deterministically enumerate every valid derivation of ``edge`` into a story of k edges
+        :param edge: (x,y)
+        :param k: length of the story, defaults to the relation length
+        :return: generator of (story, proof_trace), in the format of ``derive``
+        """
+        k = k if k is not None else self.num_rel
+        for story, proof, _ in self._proof_trees(edge, k):
+            yield list(story), list(proof)
+
+    def sample_derivation(self, edge, k=None, max_tries=100, max_trees=1000):
+        """
+        Sample a derivation uniformly from the complete set of valid derivations of ``edge``.
+        Trees are drawn uniformly among all the trees with ``count_derivations`` and the
+        ones reusing an edge are rejected. If that keeps failing, sample from the first
+        ``max_trees`` valid trees of the enumeration, as enumerating all of them is
+        exponential in k. The sample is then only uniform among these trees.
+        :param edge: (x,y)
+        :param k: length of the story, defaults to the relation length
+        :param max_tries: number of rejections before falling back to the enumeration
+        :param max_trees: number of valid trees to enumerate in the fallback
+        :return: story, proof_trace. Empty if the edge cannot be derived into k edges
+        """
+        k = k if k is not None else self.num_rel
+        if self.count_derivations(edge, k) == 0:
+            return [], []
+        for _ in range(max_tries):
+            story, proof = self._sample_proof_tree(edge, k)
+            edges = set([(min(e), max(e)) for e in story] + [(min(p[0]), max(p[0])) for p in proof])
+            if len(edges) == len(story) + len(proof):
+                return list(story), list(proof)
+        # reservoir sampling over the start of the enumeration
+        chosen = None
+        for i, (story, proof, _) in enumerate(it.islice(self._proof_trees(edge, k), max_trees)):
+            if random.randint(0, i) == 0:
+                chosen = (story, proof)
+        if chosen is None:
+            return [], []
+        return list(chosen[0]), list(chosen[1])
+
     def _get_edge_rel(self, edge, rel_type='family'):
         # get node attributes
         node_b_attr = self.anc.family_data[edge[1]]
-        relation = self.anc.family[edge][rel_type]
+        relation = self.anc.relation(edge, rel_type)
         edge_rel = self.relations_obj[relation][node_b_attr.gender]
         return edge_rel
 
     def get_edge_relation(self, edge, rel_type='family'):
         node_b_attr = self.anc.family_data[edge[1]]
-        relation = self.anc.family[edge][rel_type]
+        relation = self.anc.relation(edge, rel_type)
         edge_rel = self.relations_obj[relation][node_b_attr.gender]
         return edge_rel['rel']
 
@@ -478,6 +824,14 @@ class RelationBuilder:
         new_edge = (node_a_attr.name, node_b_attr.name)
         return new_edge
 
+    def format_query(self, puzzle):
+        """
+        Format the query of a puzzle with the current names, when its row is written
+        :param puzzle:
+        :return: (name(x), name(y)), target relation
+        """
+        return self._format_edge(puzzle.query), self.get_edge_relation(puzzle.query)
+
     def _format_edge_rel(self, edge, rel_type='family'):
         """
         Given an edge (x,y), format it into (name(x), rel(x,y), name(y))
@@ -496,30 +850,27 @@ class RelationBuilder:
         :param edge: tuple
         :return:
         """
-        # get node attributes
-        node_a_attr = self.anc.family_data[edge[0]]
-        node_b_attr = self.anc.family_data[edge[1]]
-        relation = self._get_edge_rel(edge, rel_type)
-        placeholders = relation['p']
-        placeholder = random.choice(placeholders)
-        node_a_name = node_a_attr.name
-        node_b_name = node_b_attr.name
-        assert node_a_name != node_b_name
-        if self.boundary:
-            node_a_name = '[{}]'.format(node_a_name)
-            node_b_name = '[{}]'.format(node_b_name)
-        text = placeholder.replace('e_1', node_a_name)
-        text = text.replace('e_2', node_b_name)
-        return text + '. '
-
-    def generate_puzzles(self, weight=None):
+        return self.templates.render([edge], self.anc.family, self.anc.family_data, rel_type, self.boundary)[0]
+
+    def stringify_edges(self, edges, rel_type='family'):
+        """
+        Build the story strings of a list of edges in one pass
+        :param edges: list of tuples
+        :return: dict edge : text
+        """
+        return dict(zip(edges, self.templates.render(edges, self.anc.family, self.anc.family_data,
+                                                     rel_type, self.boundary)))
+
+    def generate_puzzles(self, weight=None, prune=True):
         """
         Given stored puzzles, run `stringify` over them
         :param: extra_keys : this should contain the extra fact keys we want to add in the puzzles. We already generated
         the extra facts using `add_facts`, we just need to stringify them.
+        :param prune: prune the puzzles first, see `prune_puzzles`. Not needed if they were selected by `keep_puzzles`
         :return:
         """
-        self.prune_puzzles(weight)
+        if prune:
+            self.prune_puzzles(weight)
         extra_keys = []
         if self.args.noise_support:
             extra_keys.append('fact_1')
@@ -527,26 +878,21 @@ class RelationBuilder:
             extra_keys.append('fact_2')
         if self.args.noise_disconnected:
             extra_keys.append('fact_3')
-        puzzle_ids = self.puzzles.keys()
-        for pi in puzzle_ids:
-            self.puzzles[pi]['text_story'] = {e: self.stringify(e) for e in self.puzzles[pi]['story']}
+        for puzzle in self.puzzles.values():
+            puzzle.text_story = self.stringify_edges(puzzle.story)
             # either the target and query is reasoning from first and last, or memory retrieval from the given story
             if random.uniform(0,1) > self.args.memory:
-                self.puzzles[pi]['query'] = self.puzzles[pi]['edge']
+                puzzle.query = puzzle.edge
             else:
-                self.puzzles[pi]['query'] = random.choice(self.puzzles[pi]['story'])
-            # populate the target
-            self.puzzles[pi]['target'] = self._get_edge_rel(self.puzzles[pi]['query'])['rel']
-            self.puzzles[pi]['query_text'] = self._format_edge(self.puzzles[pi]['query'])
-            self.puzzles[pi]['text_target'] = self.stringify(self.puzzles[pi]['query'])
+                puzzle.query = random.choice(puzzle.story)
+            # populate the target. Its relation and names are looked up when the row is written, see `format_query`
+            puzzle.text_target = self.stringify(puzzle.query)
             # populate the noise
-            self.puzzles[pi]['all_noise'] = []
+            puzzle.text_facts = []
+            puzzle.all_noise = []
             for key in extra_keys:
-                self.puzzles[pi]['text_{}'.format(key)] = {e: self.stringify(e) for e in self.puzzles[pi][key]}
-                self.puzzles[pi]['all_noise'].append(self.puzzles[pi][key])
-            # replace edges with name and relations
-            self.puzzles[pi]['f_edge'] = self._format_edge_rel(self.puzzles[pi]['edge'])
-            self.puzzles[pi]['f_story'] = [self._format_edge_rel(x) for x in self.puzzles[pi]['story']]
+                puzzle.text_facts.append(self.stringify_edges(puzzle.facts[key]))
+                puzzle.all_noise.append(puzzle.facts[key])
 
     def generate_question(self, query):
         """
@@ -575,18 +921,6 @@ class RelationBuilder:
     def _unique_nodes(self, story):
         return set(self._flatten_tuples(story))
 
-    def _subset(self, story, fact, k=2):
-        """
-        Whether at least k fact nodes are present in a given story
-        :param story:
-        :param fact:
-        :return:
-        """
-        all_entities = self._unique_nodes(story)
-        all_fact_entities = self._unique_nodes(fact)
-        return len(all_entities.intersection(all_fact_entities)) >= k
-
-
     def _test_disconnected(self, story, fact):
         """
         Given a story and the fact, check whether the fact is a disconnected fact
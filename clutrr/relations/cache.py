@@ -0,0 +1,123 @@
+# Cache of closed family graphs, shared across gender flips, tasks and runs
+
+import os
+import json
+import pickle
+import hashlib
+import collections
+
+# version of the layout of ClosureEntry, part of the signatures so that older
+# entries saved on disk are not read
+CLOSURE_VERSION = 2
+
+
+def closure_mode(args):
+    """
+    Closure mode of the arguments, as used in the signatures. The bounded closure
+    depends on the relation length.
+    :param args:
+    :return: str
+    """
+    if args.closure == 'bounded':
+        return 'bounded:{}'.format(args.relation_length)
+    return args.closure
+
+
+class ClosureEntry:
+    """
+    Closed family graph of a skeleton, as arrays
+
+    - src, dst : node ids of the edges (a, b) of the closed graph, in the order of insertion
+    - codes : relation codes of the edges in ``relations``, a list code : relation
+    - expansions : dict edge : list of expansions, filled by ``precompute_expansions`` when the
+     entry is saved to disk or in a tree bank. Empty otherwise, as the expansions computed on
+     demand are only kept in the bounded cache of each builder
+    """
+    def __init__(self, src, dst, codes, relations, expansions=None):
+        self.src = src
+        self.dst = dst
+        self.codes = codes
+        self.relations = relations
+        self.expansions = expansions if expansions is not None else {}
+
+    def __len__(self):
+        return len(self.src)
+
+
+class ClosureCache:
+    """
+    Cache the closure of the family graph per tree topology.
+
+    The closure and the expansions only depend on the skeleton (the edges which
+    were simulated), not on the names or genders, so they can be reused by every
+    ``RelationBuilder`` built on the same skeleton, and across runs if a
+    ``cache_dir`` is given.
+
+    At most ``max_entries`` closed graphs are kept in memory, the least recently used
+    one is evicted first.
+    """
+    def __init__(self, max_entries=8):
+        self.entries = collections.OrderedDict()
+        self.max_entries = max_entries
+
+    def signature(self, anc, rules, mode='', rel_type='family'):
+        """
+        Canonical signature of the simulated skeleton
+        :param anc: Ancestry, before closure
+        :param rules: rules store
+        :param mode: closure mode, as different modes can close differently
+        :return: hex digest
+        """
+        skeleton = [[edge, rel] for edge, rel in anc.relations(rel_type)]
+        payload = json.dumps([CLOSURE_VERSION, mode, rules, len(anc.family_data), skeleton], sort_keys=True)
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, signature, cache_dir):
+        return os.path.join(cache_dir, 'closure_{}.pkl'.format(signature))
+
+    def get(self, signature, cache_dir=None):
+        """
+        Get the closed graph of a skeleton, from memory or from disk
+        :param signature:
+        :param cache_dir: optional directory of the disk cache
+        :return: ClosureEntry or None
+        """
+        if signature in self.entries:
+            self.entries.move_to_end(signature)
+            return self.entries[signature]
+        if cache_dir and os.path.exists(self._path(signature, cache_dir)):
+            with open(self._path(signature, cache_dir), 'rb') as fp:
+                entry = pickle.load(fp)
+            self._keep(signature, entry)
+            return entry
+        return None
+
+    def _keep(self, signature, entry):
+        self.entries[signature] = entry
+        self.entries.move_to_end(signature)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put(self, signature, entry, cache_dir=None):
+        """
+        Save the closed graph of a skeleton, in memory and on disk if ``cache_dir`` is given
+        :param signature:
+        :param entry: ClosureEntry
+        :param cache_dir: optional directory of the disk cache
+        :return:
+        """
+        self._keep(signature, entry)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            # write and rename, so that concurrent runs never read a partial file
+            tmp_path = self._path(signature, cache_dir) + '.{}.tmp'.format(os.getpid())
+            with open(tmp_path, 'wb') as fp:
+                pickle.dump(entry, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(signature, cache_dir))
+
+    def clear(self):
+        self.entries = collections.OrderedDict()
+
+
+# shared by every builder of the process
+closure_cache = ClosureCache()
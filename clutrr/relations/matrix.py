@@ -0,0 +1,155 @@
+# Vectorized closure of the family graph, using a relation matrix
+
+import numpy as np
+
+
+class RelationCodes:
+    """
+    Integer codes for the relations of a relation type in the rules store
+
+    - code 0 is reserved for "no relation"
+    - ``comp_table[a, b] = c`` if the compositional rule (a, b) : c exists
+    - ``inv_table[a] = b`` if the inverse rule a : b exists
+    - ``eq_table[a] = b`` if the equivalence rule a : b exists
+    - ``sym_table[a] = b`` if the symmetric rule a : b exists
+
+    The tables are int8 so that they can be used to gather directly from a relation matrix
+    """
+    def __init__(self, rules, rel_type='family'):
+        self.rel_type = rel_type
+        relations = []
+        for section in ['symmetric', 'equivalence', 'inverse-equivalence', 'compositional']:
+            for key, val in rules[section].get(rel_type, {}).items():
+                values = [val] if type(val) == str else [y for x in val.items() for y in x]
+                for rel in [key] + values:
+                    if rel not in relations:
+                        relations.append(rel)
+        if len(relations) >= np.iinfo(np.int8).max:
+            raise ValueError("Too many relations to encode in int8 : {}".format(len(relations)))
+        self.relations = [''] + relations  # code -> relation
+        self.codes = {rel: code for code, rel in enumerate(self.relations) if rel}
+        num_codes = len(self.relations)
+        self.comp_table = np.zeros((num_codes, num_codes), dtype=np.int8)
+        for key, val in rules['compositional'].get(rel_type, {}).items():
+            for k2, v2 in val.items():
+                self.comp_table[self.codes[key], self.codes[k2]] = self.codes[v2]
+        self.inv_table = self._unary_table(rules['inverse-equivalence'].get(rel_type, {}))
+        self.eq_table = self._unary_table(rules['equivalence'].get(rel_type, {}))
+        self.sym_table = self._unary_table(rules['symmetric'].get(rel_type, {}))
+
+    def _unary_table(self, rules):
+        table = np.zeros(len(self.relations), dtype=np.int8)
+        for key, val in rules.items():
+            table[self.codes[key]] = self.codes[val]
+        return table
+
+    def encode(self, relation):
+        return self.codes.get(relation, 0)
+
+    def decode(self, code):
+        return self.relations[code]
+
+
+class MatrixClosure:
+    """
+    Close a N x N relation matrix under the rules, in batched passes
+
+    Each pass works on the edges which were added or changed in the last pass (delta):
+        - apply the inverse, equivalence and symmetric rules on the delta
+        - compose the delta against all the edges, (x,z) + (z,y) and (z,x) + (x,y),
+         as a join on the sorted edge list, and look the new relations up in ``comp_table``
+        - only the empty cells are filled. If several compositions derive the same
+         cell in a pass, the first one wins, delta as left edge first
+    """
+    def __init__(self, codes:RelationCodes):
+        self.codes = codes
+
+    def close(self, matrix):
+        """
+        Close the matrix in place
+        :param matrix: N x N int8 matrix of relation codes
+        :return: number of passes
+        """
+        src, dst = np.nonzero(matrix)
+        passes = 0
+        while len(src) > 0:
+            src, dst = self._apply_unary(matrix, src, dst)
+            src, dst = self._compose(matrix, src, dst)
+            passes += 1
+        return passes
+
+    def _reverse(self, matrix, src, dst, table):
+        """
+        Set (y,x) from (x,y), all reads are done before the writes
+        :return: the cells which were changed
+        """
+        rel = table[matrix[src, dst]]
+        mask = rel != 0
+        n_src, n_dst, rel = dst[mask], src[mask], rel[mask]
+        changed = matrix[n_src, n_dst] != rel
+        matrix[n_src, n_dst] = rel
+        return n_src[changed], n_dst[changed]
+
+    def _apply_unary(self, matrix, src, dst):
+        """
+        Apply the inverse, equivalence and symmetric rules on the delta
+        :return: the delta, along with the cells which were changed
+        """
+        i_src, i_dst = self._reverse(matrix, src, dst, self.codes.inv_table)
+        src, dst = self._union(matrix, [src, i_src], [dst, i_dst])
+        rel = self.codes.eq_table[matrix[src, dst]]
+        mask = (rel != 0) & (rel != matrix[src, dst])
+        matrix[src[mask], dst[mask]] = rel[mask]
+        s_src, s_dst = self._reverse(matrix, src, dst, self.codes.sym_table)
+        return self._union(matrix, [src, s_src], [dst, s_dst])
+
+    def _union(self, matrix, srcs, dsts):
+        keys = np.concatenate(srcs).astype(np.int64) * matrix.shape[1] + np.concatenate(dsts)
+        keys = np.unique(keys)
+        return keys // matrix.shape[1], keys % matrix.shape[1]
+
+    def _join(self, key, ptr):
+        """
+        Pair every element of ``key`` with every edge grouped under it
+        :param key: node ids to join on
+        :param ptr: start offsets of each node in the grouped edge list
+        :return: index into ``key``, index into the grouped edge list
+        """
+        counts = ptr[key + 1] - ptr[key]
+        left = np.repeat(np.arange(len(key)), counts)
+        starts = np.repeat(ptr[key] - (np.cumsum(counts) - counts), counts)
+        return left, starts + np.arange(len(left))
+
+    def _compose(self, matrix, src, dst):
+        """
+        Compose the delta with every edge of the matrix
+        :return: the cells which were added
+        """
+        num_nodes = matrix.shape[0]
+        # edges grouped by source, and by destination
+        out_src, out_dst = np.nonzero(matrix)
+        out_ptr = np.concatenate([[0], np.cumsum(np.bincount(out_src, minlength=num_nodes))])
+        in_order = np.argsort(out_dst, kind='stable')
+        in_src, in_dst = out_src[in_order], out_dst[in_order]
+        in_ptr = np.concatenate([[0], np.cumsum(np.bincount(in_dst, minlength=num_nodes))])
+        # (x,z) in delta + (z,y)
+        left, right = self._join(dst, out_ptr)
+        x_1, y_1 = src[left], out_dst[right]
+        rel_1 = self.codes.comp_table[matrix[src[left], dst[left]], matrix[out_src[right], out_dst[right]]]
+        # (x,z) + (z,y) in delta
+        left, right = self._join(src, in_ptr)
+        x_2, y_2 = in_src[right], dst[left]
+        rel_2 = self.codes.comp_table[matrix[in_src[right], in_dst[right]], matrix[src[left], dst[left]]]
+        x = np.concatenate([x_1, x_2])
+        y = np.concatenate([y_1, y_2])
+        rel = np.concatenate([rel_1, rel_2])
+        mask = (rel != 0) & (x != y)
+        x, y, rel = x[mask], y[mask], rel[mask]
+        mask = matrix[x, y] == 0
+        x, y, rel = x[mask], y[mask], rel[mask]
+        # first derivation of a cell wins
+        _, first = np.unique(x.astype(np.int64) * num_nodes + y, return_index=True)
+        first = np.sort(first)
+        x, y, rel = x[first], y[first], rel[first]
+        matrix[x, y] = rel
+        return x, y
@@ -0,0 +1,76 @@
+# Balanced scheduling of the puzzles over their patterns (f_comb)
+
+import random
+
+
+class PatternIndex:
+    """
+    Index of the puzzles of the current family configuration by pattern
+        - patterns : dict f_comb : list of puzzle ids
+
+    The derivations do not depend on the genders, only their patterns do, so the
+    index is rebuilt after every flip from the puzzles of ``RelationBuilder.build``
+    """
+    def __init__(self, puzzles):
+        self.patterns = {}
+        for pid, puzzle in puzzles.items():
+            if puzzle.f_comb not in self.patterns:
+                self.patterns[puzzle.f_comb] = []
+            self.patterns[puzzle.f_comb].append(pid)
+
+    def __len__(self):
+        return sum([len(v) for v in self.patterns.values()])
+
+
+class PatternScheduler:
+    """
+    Quota scheduler keeping the generated patterns equally distributed.
+
+    Every pattern seen so far has a count of emitted puzzles. From the puzzles of a
+    family configuration, the scheduler repeatedly draws from the available pattern
+    with the lowest count, as long as it does not get more than one above the
+    minimum count of all the seen patterns. When none of the least emitted patterns
+    occur in the configuration, the minimum is only taken over the patterns present, so
+    that a configuration with puzzles always emits some of them. Only the drawn puzzles
+    need their facts and text to be generated, instead of pruning them afterwards.
+    """
+    def __init__(self):
+        self.counts = {} # f_comb : number of emitted puzzles
+
+    def update(self, f_comb):
+        """
+        Count an emitted puzzle
+        :param f_comb:
+        :return:
+        """
+        if f_comb not in self.counts:
+            self.counts[f_comb] = 0
+        self.counts[f_comb] += 1
+
+    def select(self, index:PatternIndex, limit=None):
+        """
+        Draw the puzzles to emit from the current index
+        :param index: PatternIndex
+        :param limit: max number of puzzles to draw
+        :return: list of puzzle ids
+        """
+        counts = dict(self.counts)
+        stock = {}
+        for f_comb, pids in index.patterns.items():
+            stock[f_comb] = random.sample(pids, len(pids))
+            if f_comb not in counts:
+                counts[f_comb] = 0
+        limit = limit if limit is not None else len(index)
+        scope = list(counts)
+        if len(stock) > 0 and min([counts[f_comb] for f_comb in stock]) > min(counts.values()):
+            scope = list(stock)
+        selected = []
+        while len(selected) < limit:
+            min_count = min([counts[f_comb] for f_comb in scope])
+            available = [f_comb for f_comb, pids in stock.items() if len(pids) > 0 and counts[f_comb] <= min_count]
+            if len(available) == 0:
+                break
+            f_comb = random.choice(available)
+            selected.append(stock[f_comb].pop())
+            counts[f_comb] += 1
+        return selected
@@ -0,0 +1,43 @@
+# Puzzle record, filled by the RelationBuilder
+
+import itertools
+
+# puzzle ids, unique in the process
+puzzle_ids = itertools.count()
+
+
+class Puzzle:
+    """
+    A story and its target, along with everything generated for it.
+    Edges are (node_id, node_id) tuples, names and relations are only looked up when rendering.
+
+    - id : integer id
+    - edge : target edge, derived from the story
+    - story : list of edges
+    - proof : list of (edge, e1, e2), where edge is expanded into e1 and e2
+    - f_comb : relations of the story, joined with '-'
+    - facts : dict of fact key ('fact_1', 'fact_2', 'fact_3') : list of noise edges, see ``add_facts``
+    - text_story : dict edge : text
+    - text_facts : list of dict edge : text, one per fact key
+    - all_noise : list of list of noise edges, one per fact key
+    - query, text_target : the query edge and the text of its answer. Its names and relation are
+     looked up by ``RelationBuilder.format_query``
+    """
+    __slots__ = ('id', 'edge', 'story', 'proof', 'f_comb', 'facts', 'text_story', 'text_facts',
+                 'all_noise', 'query', 'text_target')
+
+    def __init__(self, edge, story, proof, f_comb=''):
+        self.id = next(puzzle_ids)
+        self.edge = edge
+        self.story = story
+        self.proof = proof
+        self.f_comb = f_comb
+        self.facts = {}
+        self.text_story = {}
+        self.text_facts = []
+        self.all_noise = []
+        self.query = None
+        self.text_target = None
+
+    def __repr__(self):
+        return 'Puzzle({})'.format(', '.join(['{}={!r}'.format(key, getattr(self, key)) for key in self.__slots__]))
@@ -0,0 +1,180 @@
+# Compiled rules and relations stores. The parsed stores are cached on disk as JSON next to the YAML
+# files, or in the user cache directory if the package is not writable
+
+import os
+import sys
+import json
+import hashlib
+import yaml
+from clutrr.store.templates import SurfaceTemplates
+from clutrr.relations.matrix import RelationCodes
+
+# bump when the layout of the cached artifacts changes, to invalidate them
+COMPILED_VERSION = 2
+
+
+def code_digest():
+    """
+    Digest of the modules defining the compiled classes, so that the artifacts are compiled again
+    whenever their code changes, even without a bump of COMPILED_VERSION
+    :return: hex digest
+    """
+    digest = hashlib.sha1()
+    for module in [__name__, SurfaceTemplates.__module__, RelationCodes.__module__]:
+        with open(sys.modules[module].__file__, 'rb') as fp:
+            digest.update(fp.read())
+    return digest.hexdigest()
+
+
+def cache_dirs(rules_path):
+    """
+    Directories to cache the compiled artifacts in, by preference: next to the YAML files,
+    then the user cache directory
+    :param rules_path:
+    :return: list of directories
+    """
+    user_cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return [os.path.dirname(rules_path), os.path.join(user_cache, 'clutrr')]
+
+# use the libyaml parser if available
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def invert_rule(rule):
+    """
+    Given a rule, invert it to be RHS:LHS
+    :param rule:
+    :return:
+    """
+    inv_rules = {}
+    for tp, rules in rule.items():
+        inv_rules[tp] = {}
+        for key, val in rules.items():
+            if type(val) == str:
+                if val not in inv_rules[tp]:
+                    inv_rules[tp][val] = []
+                inv_rules[tp][val].append(key)
+            else:
+                for k2, v2 in val.items():
+                    if v2 not in inv_rules[tp]:
+                        inv_rules[tp][v2] = []
+                    inv_rules[tp][v2].append((key, k2))
+    return inv_rules
+
+
+class CompiledStore:
+    """
+    Everything derived from the rules and relations stores, computed once
+
+    - rules_store, relations_store : the parsed YAML files
+    - inverted_rules : dict section : inverted rules, see ``invert_rule``
+    - relation_codes : dict relation type : RelationCodes
+    - surface_templates : SurfaceTemplates of the relations store
+
+    The compiled stores are shared, they should not be modified.
+    """
+    def __init__(self, rules_store, relations_store):
+        self.rules_store = rules_store
+        self.relations_store = relations_store
+        self.inverted_rules = {section: invert_rule(rules_store[section])
+                               for section in ['compositional', 'inverse-equivalence', 'symmetric', 'equivalence']}
+        self.relation_codes = {rel_type: RelationCodes(rules_store, rel_type)
+                               for rel_type in rules_store['relation_types']}
+        self.surface_templates = SurfaceTemplates(relations_store)
+
+
+# compiled stores loaded in this process, by content hash
+compiled_stores = {}
+
+
+def read_artifact(cache_path, code, sources):
+    """
+    Read the parsed stores from a cached artifact. The artifact is JSON, so reading it never runs
+    any code, and it is only used if it was written by the same code from the same YAML files.
+    :param cache_path:
+    :param code: ``code_digest``
+    :param sources: sha1 hex digests of the YAML files
+    :return: rules store, relations store, or None if the artifact is missing, unreadable or stale
+    """
+    try:
+        with open(cache_path, 'r') as fp:
+            artifact = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(artifact, dict) or artifact.get('version') != COMPILED_VERSION \
+            or artifact.get('code') != code or artifact.get('sources') != sources:
+        return None
+    return artifact['rules_store'], artifact['relations_store']
+
+
+def write_artifact(cache_paths, code, sources, rules_store, relations_store):
+    """
+    Cache the parsed stores in the first writable path. Stores which JSON does not keep as is,
+    eg. with keys which are not strings, are not cached.
+    :param cache_paths: paths by preference
+    :param code: ``code_digest``
+    :param sources: sha1 hex digests of the YAML files
+    :param rules_store:
+    :param relations_store:
+    :return:
+    """
+    artifact = {'version': COMPILED_VERSION, 'code': code, 'sources': sources,
+                'rules_store': rules_store, 'relations_store': relations_store}
+    try:
+        content = json.dumps(artifact)
+    except (TypeError, ValueError):
+        return
+    if json.loads(content) != artifact:
+        return
+    for cache_path in cache_paths:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            # write and rename, so that concurrent runs never read a partial file
+            tmp_path = cache_path + '.{}.tmp'.format(os.getpid())
+            with open(tmp_path, 'w') as fp:
+                fp.write(content)
+            os.replace(tmp_path, cache_path)
+            break
+        except OSError:
+            # read only directory, try the next one. Without any, only keep it in memory
+            continue
+
+
+def load_compiled(rules_path, relations_path):
+    """
+    Load the compiled store of the given YAML files, from memory, from the artifact
+    cached next to the YAML files or in the user cache directory, or by parsing them.
+    The artifact is keyed by the contents of the YAML files and the code compiling them,
+    and holds their digests, checked before it is used.
+    :param rules_path:
+    :param relations_path:
+    :return: CompiledStore
+    """
+    contents = []
+    for path in [rules_path, relations_path]:
+        with open(path, 'rb') as fp:
+            contents.append(fp.read())
+    code = code_digest()
+    sources = [hashlib.sha1(content).hexdigest() for content in contents]
+    digest = hashlib.sha1()
+    digest.update(str(COMPILED_VERSION).encode('utf-8'))
+    digest.update(code.encode('utf-8'))
+    for source in sources:
+        digest.update(source.encode('utf-8'))
+    key = digest.hexdigest()
+    if key in compiled_stores:
+        return compiled_stores[key]
+    file_name = '.compiled_v{}_{}.json'.format(COMPILED_VERSION, key)
+    cache_paths = [os.path.join(cache_dir, file_name) for cache_dir in cache_dirs(rules_path)]
+    stores = None
+    for cache_path in cache_paths:
+        if os.path.exists(cache_path):
+            stores = read_artifact(cache_path, code, sources)
+            if stores is not None:
+                break
+    if stores is None:
+        stores = yaml.load(contents[0], Loader=YamlLoader), yaml.load(contents[1], Loader=YamlLoader)
+        write_artifact(cache_paths, code, sources, *stores)
+    compiled = CompiledStore(*stores)
+    compiled_stores[key] = compiled
+    return compiled
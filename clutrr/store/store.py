@@ -1,6 +1,6 @@
 import os
 import json
-import yaml
+from clutrr.store.compiled import load_compiled
 
 class Store:
     def __init__(self,args):
@@ -9,8 +9,12 @@ class Store:
         rules_store = args.rules_store if args.rules_store else 'rules_store.yaml'
         self.base_path = os.path.dirname(os.path.realpath(__file__)).split('store')[0]
         self.attribute_store = json.load(open(os.path.join(self.base_path, 'store', attribute_store)))
-        self.relations_store = yaml.load(open(os.path.join(self.base_path, 'store', relations_store)))
-        self.rules_store = yaml.load(open(os.path.join(self.base_path, 'store', rules_store)))
+        # parsed and compiled once, see ``CompiledStore``
+        self.compiled = load_compiled(os.path.join(self.base_path, 'store', rules_store),
+                                      os.path.join(self.base_path, 'store', relations_store))
+        self.relations_store = self.compiled.relations_store
+        self.rules_store = self.compiled.rules_store
+        self.surface_templates = self.compiled.surface_templates
 
         # TODO: do we need this?
         ## Relationship type has basic values 0,1 and 2, whereas the
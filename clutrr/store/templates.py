@@ -0,0 +1,175 @@
+# Surface templates of the relations store and AMT templates, compiled once
+
+import os
+import re
+import json
+import random
+
+SLOTS = re.compile('(e_1|e_2)')
+# placeholders of the AMT templates, ENT_<entity id>_<gender>
+ENT_SLOTS = re.compile('(ENT_[0-9]+_[a-z]+)')
+
+
+def format_segments(segments):
+    """
+    Format string of a list of literal strings and slot ids
+    :param segments:
+    :return: str
+    """
+    return ''.join([seg.replace('{', '{{').replace('}', '}}') if type(seg) == str else '{%d}' % seg
+                    for seg in segments])
+
+
+class Template:
+    """
+    A placeholder of the relations store, such as "e_2 is a son of e_1",
+    pre-split into literal and slot segments
+
+    - segments : list of literal strings and slot ids, 0 for e_1 and 1 for e_2
+    - fmt : format string of the segments, ending with the sentence separator
+    """
+    __slots__ = ('text', 'segments', 'fmt')
+
+    def __init__(self, text):
+        self.text = text
+        self.segments = []
+        for i, part in enumerate(SLOTS.split(text)):
+            if i % 2 == 1:
+                self.segments.append(0 if part == 'e_1' else 1)
+            elif part:
+                self.segments.append(part)
+        self.fmt = format_segments(self.segments) + '. '
+
+    def render(self, name_a, name_b):
+        return self.fmt.format(name_a, name_b)
+
+
+class SurfaceTemplates:
+    """
+    Relations store compiled into templates, indexed by (relation code, gender)
+
+    - codes : dict relation : code
+    - index : dict (code, gender) : list of Template
+    """
+    def __init__(self, relations_store):
+        self.codes = {}
+        self.index = {}
+        for relation, genders in relations_store.items():
+            self.codes[relation] = len(self.codes)
+            for gender, val in genders.items():
+                if type(val) == dict and 'p' in val:
+                    self.index[(self.codes[relation], gender)] = [Template(p) for p in val['p']]
+
+    def get(self, relation, gender):
+        """
+        :param relation: relation of the relations store, such as 'child'
+        :param gender: gender of the target node
+        :return: list of Template
+        """
+        return self.index[(self.codes[relation], gender)]
+
+    def render(self, edges, family, family_data, rel_type='family', boundary=False):
+        """
+        Render a list of edges into text in one pass. Names are looked up, and bracketed
+        if ``boundary``, once per node of the list
+        :param edges: list of (x,y)
+        :param family: dict (x,y) : relations, see ``Ancestry.family``
+        :param family_data: dict node_id : Actor
+        :param rel_type:
+        :param boundary: put the names in [ ]
+        :return: list of text, one per edge
+        """
+        names = {}
+        for edge in edges:
+            for node in edge:
+                if node not in names:
+                    name = family_data[node].name
+                    names[node] = '[{}]'.format(name) if boundary else name
+        texts = []
+        for x, y in edges:
+            assert family_data[x].name != family_data[y].name
+            template = random.choice(self.get(family[(x, y)][rel_type], family_data[y].gender))
+            texts.append(template.fmt.format(names[x], names[y]))
+        return texts
+
+
+class AmtTemplate:
+    """
+    A paraphrase collected on AMT, such as "ENT_0_male is the father of ENT_1_female",
+    pre-split into literal and slot segments for its gender combination. Placeholders
+    which do not match an entity of the gender combination are kept as text.
+
+    - segments : list of literal strings and entity ids
+    - fmt : format string of the segments
+    """
+    __slots__ = ('text', 'segments', 'fmt')
+
+    def __init__(self, text, genders):
+        """
+        :param text:
+        :param genders: list of the genders of the entities, by entity id
+        """
+        self.text = text
+        self.segments = []
+        for i, part in enumerate(ENT_SLOTS.split(text)):
+            if i % 2 == 1:
+                _, ent_id, gender = part.split('_')
+                ent_id = int(ent_id)
+                if ent_id < len(genders) and genders[ent_id] == gender:
+                    self.segments.append(ent_id)
+                    continue
+            if part:
+                self.segments.append(part)
+        self.fmt = format_segments(self.segments)
+
+    def render(self, names):
+        """
+        :param names: names of the entities, by entity id
+        :return: str
+        """
+        return self.fmt.format(*names)
+
+
+class AmtTemplates:
+    """
+    AMT templates indexed by (f_comb, gender_comb), such as ('father-sister', 'male-male-female').
+    Only the keys with templates are kept. All the templates are compiled into AmtTemplate when
+    loaded, and never written afterwards, so the forked workers share them read-only.
+
+    - index : dict (f_comb, gender_comb) : list of AmtTemplate
+    """
+    def __init__(self, templates):
+        """
+        :param templates: dict f_comb : gender_comb : list of text, as in amt_placeholders.json
+        """
+        self.index = {(f_comb, gender_comb): [AmtTemplate(text, gender_comb.split('-')) for text in texts]
+                      for f_comb, genders in templates.items()
+                      for gender_comb, texts in genders.items() if len(texts) > 0}
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, f_comb, gender_comb):
+        """
+        :return: list of AmtTemplate
+        """
+        return self.index[(f_comb, gender_comb)]
+
+
+# AMT templates loaded in this process, by path and modification time. Loaded before
+# the worker processes are forked, they are shared with the workers.
+amt_templates = {}
+
+
+def load_amt_templates(path):
+    """
+    Load and compile the AMT templates of a file, once per process
+    :param path: json file, see ``AmtTemplates``
+    :return: AmtTemplates
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in amt_templates:
+        with open(path) as fp:
+            amt_templates[key] = AmtTemplates(json.load(fp))
+    return amt_templates[key]
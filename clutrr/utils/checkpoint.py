@@ -0,0 +1,114 @@
+# Checkpoint of a sharded generation, to resume it
+
+import os
+import json
+import threading
+
+
+class Checkpoint:
+    """
+    Manifest of the shards completed in a dataset folder, saved after every shard
+
+    - args : args of the run, so that it can be resumed as it started
+    - shards : dict shard file : {'seed', 'rows', 'f_comb_count'}. The seed sets the
+     RNG state of the shard, so a completed shard is never generated again and a
+     missing one is generated identically. A shard is removed once its rows are written
+     to the dataset file, see ``merged``.
+    - files : dict dataset file : number of row ids used by the file, for the dataset files
+     completed. They are not written again when resuming.
+    """
+    FILE = 'checkpoint.json'
+
+    def __init__(self, directory, args=None, shards=None, files=None):
+        self.directory = directory
+        self.path = os.path.join(directory, self.FILE)
+        self.args = dict(args) if args else {}
+        self.shards = shards if shards else {}
+        self.files = files if files else {}
+        # shards are completed from the pool result thread
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, directory):
+        """
+        :param directory: dataset folder of the run to resume
+        :return: Checkpoint
+        """
+        path = os.path.join(directory, cls.FILE)
+        if not os.path.exists(path):
+            raise FileNotFoundError("No checkpoint to resume in {}. Only the runs with --seed or "
+                                    "--workers > 1 are checkpointed".format(directory))
+        with open(path) as fp:
+            manifest = json.load(fp)
+        return cls(directory, manifest['args'], manifest['shards'], manifest.get('files'))
+
+    def done(self, shard):
+        """
+        Whether a shard was completed, and its file is still there
+        :param shard: shard file name
+        :return: bool
+        """
+        return shard in self.shards and os.path.exists(os.path.join(self.directory, shard))
+
+    def complete(self, shard, info):
+        """
+        Record a completed shard and save the manifest
+        :param shard: shard file name
+        :param info: dict of seed, rows and f_comb_count
+        :return:
+        """
+        with self.lock:
+            self.shards[shard] = info
+            self.save()
+
+    def merged(self, shard):
+        """
+        Remove a shard once its rows are written to the dataset file. If the run is interrupted
+        before the file is complete, the shard is generated again when resuming.
+        :param shard: shard file name
+        :return:
+        """
+        with self.lock:
+            self.shards.pop(shard, None)
+            if os.path.exists(os.path.join(self.directory, shard)):
+                os.remove(os.path.join(self.directory, shard))
+            self.save()
+
+    def file_done(self, name):
+        """
+        Whether a dataset file was completed, and is still there
+        :param name: dataset file name
+        :return: bool
+        """
+        return name in self.files and os.path.exists(os.path.join(self.directory, name))
+
+    def complete_file(self, name, num_ids):
+        """
+        Record a completed dataset file and save the manifest
+        :param name: dataset file name
+        :param num_ids: number of row ids used by the file, skipped when resuming
+        :return:
+        """
+        with self.lock:
+            self.files[name] = num_ids
+            self.save()
+
+    def save(self):
+        # write and rename, so that an interrupted run never leaves a partial manifest
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump({'args': self.args, 'shards': self.shards, 'files': self.files}, fp)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        """
+        Remove the manifest and the shard files, once the dataset is complete
+        :return:
+        """
+        for shard in self.shards:
+            if os.path.exists(os.path.join(self.directory, shard)):
+                os.remove(os.path.join(self.directory, shard))
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.shards = {}
+        self.files = {}
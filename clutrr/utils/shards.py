@@ -0,0 +1,131 @@
+# Sharded generation of the rows of a task, optionally over a process pool
+
+import os
+import copy
+import random
+import hashlib
+import logging
+import logging.handlers
+import numpy as np
+from clutrr.generator import generate_rows, COLUMNS
+from clutrr.store.store import Store
+from clutrr.utils.sinks import SpillSink, read_spill
+
+
+def shard_seed(seed, key, index):
+    """
+    Seed of a shard, derived from the master seed, so that it does not depend on the
+    number of workers
+    :param seed: master seed
+    :param key: task key, such as 'task_1.3.train'
+    :param index: shard index
+    :return: int
+    """
+    digest = hashlib.sha1('{}:{}:{}'.format(seed, key, index).encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'little')
+
+
+def plan_shards(num_rows, shard_rows):
+    """
+    Split num_rows into shards of shard_rows rows, the last one taking the rest
+    :return: list of shard sizes
+    """
+    sizes = [shard_rows] * (num_rows // shard_rows)
+    if num_rows % shard_rows > 0:
+        sizes.append(num_rows % shard_rows)
+    return sizes
+
+
+def init_worker(queue):
+    """
+    Send the logs of a worker process to the parent process, see ``logging.handlers.QueueListener``
+    :param queue: multiprocessing queue
+    """
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(queue)]
+    root.setLevel(logging.INFO)
+
+
+def generate_shard(job):
+    """
+    Generate the rows of a shard, with its own family tree, and spill them to disk.
+    Runs in the worker processes.
+    :param job: (args, task_name, seed, spill_path)
+    :return: spill_path, info of the shard for the checkpoint
+    """
+    args, task_name, seed, spill_path = job
+    random.seed(seed)
+    np.random.seed(seed)
+    store = Store(args)
+    f_comb_col = COLUMNS.index('f_comb')
+    f_comb_count = {}
+    # write and rename, so that an interrupted shard is never read
+    with SpillSink(spill_path + '.tmp', COLUMNS, args.chunk_size) as sink:
+        for row in generate_rows(args, store, task_name):
+            f_comb_count[row[f_comb_col]] = f_comb_count.get(row[f_comb_col], 0) + 1
+            sink.write(row)
+    os.replace(spill_path + '.tmp', spill_path)
+    logging.getLogger().info("{} : {} rows generated".format(os.path.basename(spill_path), sink.num_rows))
+    return spill_path, {'seed': seed, 'rows': sink.num_rows, 'f_comb_count': f_comb_count}
+
+
+def sharded_rows(args, task_name, tmp_dir, row_ids, pool=None, checkpoint=None):
+    """
+    Generate the rows of a task in shards of ``args.shard_rows`` rows, seeded from ``args.seed``.
+    The rows are yielded in shard order with ids from ``row_ids``, so the output only
+    depends on the master seed, whatever the number of workers.
+    With a pool, the shards are submitted right away, so that the shards of all the tasks
+    of a run are generated concurrently while the rows are consumed task by task.
+    :param args: args of the task, see ``Clutrr.generate``
+    :param task_name:
+    :param tmp_dir: directory of the shard files
+    :param row_ids: iterator of row ids, shared by the tasks of a run
+    :param pool: multiprocessing pool, or None to generate in this process
+    :param checkpoint: Checkpoint. The completed shards are read back instead of generated, the
+     others are recorded as they complete. Each shard file is removed once read, see ``Checkpoint.merged``
+    :return: generator of rows
+    """
+    key = '{}.{}'.format(task_name, args.data_type)
+    jobs = []
+    for index, size in enumerate(plan_shards(args.num_rows, args.shard_rows)):
+        shard_args = copy.deepcopy(args)
+        shard_args.num_rows = size
+        spill_path = os.path.join(tmp_dir, '.shard_{}_{}.spill'.format(key, index))
+        jobs.append((shard_args, task_name, shard_seed(args.seed, key, index), spill_path))
+    results = []
+    for job in jobs:
+        spill_path = job[-1]
+        if checkpoint is not None and checkpoint.done(os.path.basename(spill_path)):
+            results.append(spill_path)
+        elif pool is not None:
+            results.append(pool.apply_async(generate_shard, (job,), callback=_completed(checkpoint)))
+        else:
+            results.append(job)
+    return _read_shards(results, row_ids, checkpoint)
+
+
+def _completed(checkpoint):
+    def callback(result):
+        if checkpoint is not None:
+            checkpoint.complete(os.path.basename(result[0]), result[1])
+    return callback
+
+
+def _read_shards(results, row_ids, checkpoint=None):
+    for result in results:
+        if isinstance(result, str):
+            # completed before
+            spill_path = result
+        elif isinstance(result, tuple):
+            # job to run in this process
+            spill_path, info = generate_shard(result)
+            _completed(checkpoint)((spill_path, info))
+        else:
+            spill_path, info = result.get()
+        for row in read_spill(spill_path):
+            row[0] = next(row_ids)
+            yield row
+        if checkpoint is None:
+            os.remove(spill_path)
+        else:
+            checkpoint.merged(os.path.basename(spill_path))
@@ -0,0 +1,184 @@
+# Sinks writing the generated rows to disk in fixed size chunks
+
+import json
+import pickle
+import pandas as pd
+
+
+class RowSink:
+    """
+    Base sink. Rows are buffered and written every ``chunk_size`` rows, so the memory
+    does not grow with the number of rows.
+    Subclasses implement ``_write_chunk`` and optionally ``_close``.
+    """
+    def __init__(self, path, columns, chunk_size=10000):
+        self.path = path
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.rows = []
+        self.num_rows = 0 # rows written to disk
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        if len(self.rows) > 0:
+            self._write_chunk(self.rows)
+            self.num_rows += len(self.rows)
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self._close()
+
+    def _write_chunk(self, rows):
+        raise NotImplementedError()
+
+    def _close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CsvSink(RowSink):
+    """
+    CSV file, in the format of ``DataFrame.to_csv`` without the index column. The ``id``
+    column is the key of the rows, unique across the files of a run, also when it is
+    resumed or generated in shards
+    """
+    def __init__(self, path, columns, chunk_size=10000):
+        super().__init__(path, columns, chunk_size)
+        self.fp = open(path, 'w', newline='')
+
+    def _write_chunk(self, rows):
+        df = pd.DataFrame(columns=self.columns, data=rows)
+        df.to_csv(self.fp, header=self.num_rows == 0, index=False)
+
+    def _close(self):
+        if self.num_rows == 0:
+            pd.DataFrame(columns=self.columns).to_csv(self.fp, index=False)
+        self.fp.close()
+
+
+def _jsonable(value):
+    """Tuples become lists, and dict keys which are not strings are written as in the CSV files"""
+    if isinstance(value, dict):
+        return {(k if isinstance(k, str) else str(tuple(_jsonable(k)) if isinstance(k, tuple) else k)): _jsonable(v)
+                for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if hasattr(value, 'item'):
+        # numpy scalars
+        return value.item()
+    return value
+
+
+class JsonlSink(RowSink):
+    """
+    One JSON object per row
+    """
+    def __init__(self, path, columns, chunk_size=10000):
+        super().__init__(path, columns, chunk_size)
+        self.fp = open(path, 'w')
+
+    def _write_chunk(self, rows):
+        self.fp.write(''.join([json.dumps(_jsonable(dict(zip(self.columns, row)))) + '\n' for row in rows]))
+
+    def _close(self):
+        self.fp.close()
+
+
+class ParquetSink(RowSink):
+    """
+    Parquet file, one row group per chunk. Requires pyarrow.
+    Lists and dicts are written as strings, as in the CSV files, to keep the schema flat.
+    """
+    def __init__(self, path, columns, chunk_size=10000):
+        super().__init__(path, columns, chunk_size)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("pyarrow is required to write parquet files, pip install pyarrow")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.writer = None
+
+    def _table(self, rows):
+        data = {col: [v if isinstance(v, (str, int, float)) else str(v) for v in values]
+                for col, values in zip(self.columns, zip(*rows))} if rows else {col: [] for col in self.columns}
+        schema = self.writer.schema if self.writer else None
+        return self.pa.Table.from_pydict(data, schema=schema)
+
+    def _write_chunk(self, rows):
+        table = self._table(rows)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def _close(self):
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, self._table([]).schema)
+        self.writer.close()
+
+
+class SpillSink(RowSink):
+    """
+    Temporary file of pickled chunks, to read the rows back with ``read_spill``
+    """
+    def __init__(self, path, columns, chunk_size=10000):
+        super().__init__(path, columns, chunk_size)
+        self.fp = open(path, 'wb')
+
+    def _write_chunk(self, rows):
+        pickle.dump(rows, self.fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _close(self):
+        self.fp.close()
+
+
+def read_spill(path):
+    """
+    Iterate over the rows of a ``SpillSink`` file
+    :param path:
+    :return: generator of rows
+    """
+    with open(path, 'rb') as fp:
+        while True:
+            try:
+                rows = pickle.load(fp)
+            except EOFError:
+                break
+            for row in rows:
+                yield row
+
+
+SINKS = {
+    'csv': CsvSink,
+    'jsonl': JsonlSink,
+    'parquet': ParquetSink
+}
+
+
+def make_sink(path, columns, output_format='csv', chunk_size=10000):
+    """
+    :param path: output file
+    :param columns: column names of the rows
+    :param output_format: one of ``SINKS``
+    :param chunk_size: number of rows buffered before writing
+    :return: RowSink
+    """
+    if output_format not in SINKS:
+        raise NotImplementedError("output format {} not supported, choose from {}".format(
+            output_format, ', '.join(SINKS.keys())))
+    return SINKS[output_format](path, columns, chunk_size)
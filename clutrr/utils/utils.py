@@ -126,4 +126,34 @@ def comb_indexes(sn, max_seq_len=3):
     return pairs
 
 def choose_random_subsequence(sn, max_seq_len=3):
-    return random.choice(comb_indexes(sn, max_seq_len))
\ No newline at end of file
+    return random.choice(comb_indexes(sn, max_seq_len))
+
+def sample_grouping(sn, max_seq_len=3, is_valid=None):
+    """
+    Sample uniformly one of the combinations of ``comb_indexes`` whose groups are all valid,
+    without enumerating them. counts[i] is the number of valid combinations of sn[i:],
+    computed backwards over the positions, then the groups are drawn forwards weighted by
+    the counts of the rest of the sequence.
+    :param sn:
+    :param max_seq_len:
+    :param is_valid: function of a group (a slice of sn) returning bool. All groups are valid if None
+    :return: list of groups, or None if there is no valid combination
+    """
+    s_n = len(sn)
+    counts = [0] * (s_n + 1)
+    counts[s_n] = 1
+    lengths = [[] for _ in range(s_n)] # valid group lengths starting at each position
+    for i in range(s_n - 1, -1, -1):
+        for l in range(1, min(max_seq_len, s_n - i) + 1):
+            if counts[i + l] > 0 and (is_valid is None or is_valid(sn[i:i + l])):
+                lengths[i].append(l)
+                counts[i] += counts[i + l]
+    if counts[0] == 0:
+        return None
+    groups = []
+    i = 0
+    while i < s_n:
+        l = random.choices(lengths[i], weights=[counts[i + l] for l in lengths[i]])[0]
+        groups.append(sn[i:i + l])
+        i += l
+    return groups
@@ -0,0 +1,62 @@
+# A sharded run interrupted and resumed from its checkpoint writes the rows of an uninterrupted run
+
+import os
+import itertools
+from clutrr.args import get_parser
+from clutrr.utils.checkpoint import Checkpoint
+from clutrr.utils.shards import sharded_rows, plan_shards
+
+TASK = 'task_1.2'
+
+
+def task_args():
+    args = get_parser().parse_args(['--max_names', '200', '--seed', '7', '--shard_rows', '4'])
+    args.num_rows = 10
+    args.data_type = 'train'
+    args.relation_length = 2
+    return args
+
+
+def test_plan_shards():
+    assert plan_shards(10, 4) == [4, 4, 2]
+    assert plan_shards(8, 4) == [4, 4]
+    assert plan_shards(0, 4) == []
+
+
+def test_checkpoint_round_trip(tmp_path):
+    directory = str(tmp_path)
+    checkpoint = Checkpoint(directory, {'seed': 7})
+    checkpoint.complete('.shard_a.spill', {'seed': 1, 'rows': 4, 'f_comb_count': {}})
+    checkpoint.complete_file('train.csv', 10)
+    open(os.path.join(directory, '.shard_a.spill'), 'w').close()
+    open(os.path.join(directory, 'train.csv'), 'w').close()
+    loaded = Checkpoint.load(directory)
+    assert loaded.args == {'seed': 7}
+    assert loaded.done('.shard_a.spill') and not loaded.done('.shard_b.spill')
+    assert loaded.file_done('train.csv')
+    loaded.merged('.shard_a.spill')
+    assert not Checkpoint.load(directory).done('.shard_a.spill')
+    assert not os.path.exists(os.path.join(directory, '.shard_a.spill'))
+    loaded.clear()
+    assert not os.path.exists(loaded.path)
+
+
+def test_resume(tmp_path):
+    args = task_args()
+    full_dir, run_dir = tmp_path / 'full', tmp_path / 'run'
+    full_dir.mkdir()
+    run_dir.mkdir()
+    full = list(sharded_rows(args, TASK, str(full_dir), itertools.count()))
+    assert len(full) == args.num_rows
+    assert os.listdir(str(full_dir)) == []
+
+    # interrupt the run in the middle of the second shard
+    checkpoint = Checkpoint(str(run_dir), vars(args))
+    rows = sharded_rows(args, TASK, str(run_dir), itertools.count(), checkpoint=checkpoint)
+    list(itertools.islice(rows, args.shard_rows + 1))
+    rows.close()
+    resumed = Checkpoint.load(str(run_dir))
+    # the first shard was written out and removed, the second one is kept
+    assert [shard.split('_')[-1] for shard in resumed.shards] == ['1.spill']
+    resumed_rows = list(sharded_rows(args, TASK, str(run_dir), itertools.count(), checkpoint=resumed))
+    assert resumed_rows == full
@@ -0,0 +1,70 @@
+# The worklist closure derives the same graph as the recursive closure of the original builder
+
+import io
+import random
+import contextlib
+import numpy as np
+import pytest
+from clutrr.args import get_parser
+from clutrr.store.store import Store
+from clutrr.actors.ancestry import Ancestry
+from clutrr.relations.builder import RelationBuilder
+from clutrr.relations.cache import closure_cache
+
+
+def baseline_closure(family, num_nodes, rules, rel_type='family'):
+    """
+    Recursive closure of the original ``RelationBuilder.apply_almost_complete``, on a dict
+    edge : relation
+    """
+    comp_rules = rules['compositional'].get(rel_type, {})
+    unary_rules = [(rules['inverse-equivalence'].get(rel_type, {}), True),
+                   (rules['equivalence'].get(rel_type, {}), False),
+                   (rules['symmetric'].get(rel_type, {}), True)]
+
+    def compose(edge_1, edge_2):
+        if edge_1[0] == edge_1[1] or edge_2[0] == edge_2[1]:
+            return None
+        if edge_1[1] == edge_2[0] and edge_1[0] != edge_2[1]:
+            n_edge = (edge_1[0], edge_2[1])
+            if n_edge not in family and edge_1 in family and family[edge_1] in comp_rules:
+                if edge_2 in family and family[edge_2] in comp_rules[family[edge_1]]:
+                    family[n_edge] = comp_rules[family[edge_1]][family[edge_2]]
+                    return n_edge
+        return None
+
+    def almost_complete(edge):
+        for table, swap in unary_rules:
+            for (x, y), relation in list(family.items()):
+                if relation in table:
+                    family[(y, x) if swap else (x, y)] = table[relation]
+        keys = list(family.keys())
+        edges_1 = [compose(e, edge) for e in keys if e[1] == edge[0]]
+        edges_2 = [compose(edge, e) for e in keys if e[0] == edge[1]]
+        for e in [e for e in edges_1 + edges_2 if e is not None]:
+            almost_complete(e)
+
+    for i in range(num_nodes):
+        for j in range(num_nodes):
+            if i != j:
+                almost_complete((i, j))
+    return family
+
+
+@pytest.mark.parametrize('seed,tree_args', [
+    (0, ['--max_levels', '2', '--min_child', '2', '--max_child', '3', '--p_marry', '0.8']),
+    (1, ['--max_levels', '3', '--min_child', '1', '--max_child', '2', '--p_marry', '0.7']),
+    (2, ['--max_levels', '3', '--min_child', '2', '--max_child', '2']),
+])
+def test_worklist_closure_matches_baseline(seed, tree_args):
+    args = get_parser().parse_args(['--max_names', '200'] + tree_args)
+    store = Store(args)
+    random.seed(seed)
+    np.random.seed(seed)
+    anc = Ancestry(args, store)
+    skeleton = {edge: relation['family'] for edge, relation in anc.family.items()}
+    closure_cache.clear()
+    with contextlib.redirect_stdout(io.StringIO()):
+        RelationBuilder(args, store, anc)
+    closed = {edge: relation['family'] for edge, relation in anc.family.items()}
+    assert closed == baseline_closure(skeleton, len(anc.family_data), store.rules_store)
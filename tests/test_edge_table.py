@@ -0,0 +1,89 @@
+# EdgeTable answers the same lookups written, frozen, thawed and bulk loaded
+
+import random
+import pytest
+from clutrr.actors import edge_table
+from clutrr.actors.edge_table import EdgeTable
+
+RELATIONS = ['father', 'mother', 'son', 'daughter', 'husband', 'wife']
+
+
+def random_edges(seed, num_nodes=12, num_edges=60):
+    rng = random.Random(seed)
+    edges = {}
+    while len(edges) < num_edges:
+        x, y = rng.randrange(num_nodes), rng.randrange(num_nodes)
+        if x != y:
+            edges[(x, y)] = rng.choice(RELATIONS)
+    return list(edges.items())
+
+
+def make_table(edges):
+    table = EdgeTable()
+    for edge, relation in edges:
+        table.set(table.add(edge), relation)
+    return table
+
+
+def check_table(table, edges, num_nodes=12):
+    relations = dict(edges)
+    assert table.items() == edges
+    for x in range(num_nodes):
+        assert list(table.out_nodes(x)) == [b for (a, b), _ in edges if a == x]
+        assert list(table.in_nodes(x)) == [a for (a, b), _ in edges if b == x]
+        for relation in RELATIONS:
+            assert list(table.neighbours(x, relation)) == sorted(b for (a, b), r in edges if a == x and r == relation)
+            assert list(table.neighbours(x, relation, incoming=True)) == \
+                sorted(a for (a, b), r in edges if b == x and r == relation)
+        for y in range(-1, num_nodes + 1):
+            assert ((x, y) in table) == ((x, y) in relations)
+            if (x, y) in relations:
+                assert table.relation((x, y)) == relations[(x, y)]
+            else:
+                with pytest.raises(KeyError):
+                    table.relation((x, y))
+
+
+@pytest.mark.parametrize('dense_cells', [edge_table.DENSE_CELLS_PER_EDGE, 0])
+def test_freeze_thaw(monkeypatch, dense_cells):
+    monkeypatch.setattr(edge_table, 'DENSE_CELLS_PER_EDGE', dense_cells)
+    edges = random_edges(0)
+    table = make_table(edges)
+    check_table(table, edges)
+    table.freeze()
+    assert table.csr is not None
+    assert (table.dense is not None) == (dense_cells > 0)
+    check_table(table, edges)
+    # a write thaws the table
+    edge = edges[0][0]
+    table.set(table.row(edge), 'wife' if edges[0][1] != 'wife' else 'husband')
+    edges[0] = (edge, table.relation(edge))
+    assert table.csr is None
+    table.set(table.add((0, 12)), 'son')
+    edges.append(((0, 12), 'son'))
+    check_table(table, edges, num_nodes=13)
+    table.freeze()
+    check_table(table, edges, num_nodes=13)
+
+
+def test_load():
+    edges = random_edges(1)
+    table = make_table(edges)
+    src, dst, codes, relations = table.arrays()
+    # a table holding the first edges, with the relations coded in another order
+    loaded = EdgeTable()
+    for relation in reversed(RELATIONS):
+        loaded.code(relation)
+    for edge, relation in edges[:10]:
+        loaded.set(loaded.add(edge), relation)
+    loaded.load(src.copy(), dst.copy(), codes.copy(), list(relations))
+    assert loaded.csr is not None
+    check_table(loaded, edges)
+
+
+def test_load_mismatch():
+    edges = random_edges(2)
+    src, dst, codes, relations = make_table(edges).arrays()
+    table = make_table([((dst[0], src[0]), 'son')])
+    with pytest.raises(ValueError):
+        table.load(src.copy(), dst.copy(), codes.copy(), list(relations))
@@ -0,0 +1,57 @@
+# The sinks write all the rows, across chunks, and read back as written
+
+import json
+import pandas as pd
+import pytest
+from clutrr.utils.sinks import make_sink, SpillSink, read_spill
+
+COLUMNS = ['id', 'story', 'query', 'genders']
+
+
+def make_rows(num):
+    return [[i, 'story {}'.format(i), (i, i + 1), {'male': [i]}] for i in range(num)]
+
+
+@pytest.mark.parametrize('num_rows', [0, 3, 10, 23])
+def test_csv(tmp_path, num_rows):
+    path = str(tmp_path / 'rows.csv')
+    with make_sink(path, COLUMNS, 'csv', chunk_size=10) as sink:
+        sink.write_rows(make_rows(num_rows))
+    assert sink.num_rows == num_rows
+    df = pd.read_csv(path)
+    assert list(df.columns) == COLUMNS
+    assert df['id'].tolist() == list(range(num_rows))
+    assert df['story'].tolist() == ['story {}'.format(i) for i in range(num_rows)]
+    # tuples are written as in DataFrame.to_csv
+    assert df['query'].tolist() == [str((i, i + 1)) for i in range(num_rows)]
+
+
+def test_jsonl(tmp_path):
+    path = str(tmp_path / 'rows.jsonl')
+    with make_sink(path, COLUMNS, 'jsonl', chunk_size=10) as sink:
+        sink.write_rows(make_rows(23))
+    with open(path) as fp:
+        rows = [json.loads(line) for line in fp]
+    assert rows == [{'id': i, 'story': 'story {}'.format(i), 'query': [i, i + 1], 'genders': {'male': [i]}}
+                    for i in range(23)]
+
+
+def test_parquet(tmp_path):
+    pytest.importorskip('pyarrow')
+    path = str(tmp_path / 'rows.parquet')
+    with make_sink(path, COLUMNS, 'parquet', chunk_size=10) as sink:
+        sink.write_rows(make_rows(23))
+    df = pd.read_parquet(path)
+    assert df['id'].tolist() == list(range(23))
+
+
+def test_spill(tmp_path):
+    path = str(tmp_path / 'rows.spill')
+    with SpillSink(path, COLUMNS, chunk_size=10) as sink:
+        sink.write_rows(make_rows(23))
+    assert list(read_spill(path)) == make_rows(23)
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(NotImplementedError):
+        make_sink(str(tmp_path / 'rows.xml'), COLUMNS, 'xml')